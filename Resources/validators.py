@@ -1,9 +1,18 @@
 import re
 from typing import Tuple
 
+# Directory Modules
+import config
+from user_store import FIND_USER, normalise_email
 
-async def check_if_user_exists(cur, email) -> bool:
-    if await cur.fetchrow('SELECT 1 FROM users WHERE email = $1', email):
+
+async def check_if_user_exists(conn, email) -> bool:
+    """
+    :param conn: [user_store.UserConnection] - pool connection, which has the lookup prepared
+    :param email: [str]
+    :return: True if the email has an account, or a signup for it is still in progress
+    """
+    if await conn.fetchval(FIND_USER, normalise_email(email), config.SIGNUP_CLAIM_TTL):
         return True
     return False
 
@@ -1,18 +1,26 @@
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import time
 from contextlib import asynccontextmanager
 
+_import_started = time.perf_counter()
+
 # Directory Modules
 import config
-from auth import auth
-from customer import customer
-from payments import payments
+import http_client
+import log
+import metrics
+import webhook_queue
+from stats_store import stats_store
 
 # FastAPI
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-
-from products import products
-from webhooks import webhooks
+from fastapi.responses import PlainTextResponse
 
 
 class CustomHTTPException(HTTPException):
@@ -20,14 +28,89 @@ class CustomHTTPException(HTTPException):
         super().__init__(status_code=status_code, detail=detail)
 
 
+log.setup_logging()
+logger = logging.getLogger(__name__)
+
 # Env Vars
 origins = [
     "http://127.0.0.1:8000"
 ]
 
+# Each module defines a router of the same name. Disabled routers' modules are never imported
+ROUTERS = ("auth", "payments", "customer", "products", "webhooks")
+
+unknown_routers = set(config.ENABLED_ROUTERS) - set(ROUTERS)
+if unknown_routers:
+    raise ValueError(f"Unknown ENABLED_ROUTERS: {', '.join(sorted(unknown_routers))}")
+routers = {name: importlib.import_module(name) for name in config.ENABLED_ROUTERS}
+auth = routers.get("auth")
+webhooks = routers.get("webhooks")
+payments = routers.get("payments")
+
+
+def loaded_gateway():
+    """The gateway module if an enabled router imported it; webhooks-only processes never do"""
+    return sys.modules.get("stripe_gateway")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Runs once per worker process: everything opened here belongs to this worker's event loop
+    """
+    logger.info("Worker starting", extra={
+        "pid": os.getpid(),
+        "loop": type(asyncio.get_running_loop()).__module__,
+        "routers": list(routers),
+        "import_ms": round(import_seconds * 1000, 1),
+    })
+    await http_client.open_session()
+    gateway = loaded_gateway()
+    if gateway is not None:
+        gateway.open_http_client()
+    if auth is not None:
+        if not config.DATABASE_URL:
+            logger.warning("DATABASE_URL is not set, signups will not be checked for duplicates")
+        await auth.user_store.open()
+    if webhooks is not None:
+        if not config.STRIPE_WEBHOOK_SECRETS:
+            logger.warning("STRIPE_WEBHOOK_SIGNING_SECRET is not set, webhook signatures will not be verified")
+        await webhooks.deduplicator.purge()
+        await webhook_queue.start(webhooks.process_bytes)
+    backfill = None
+    if payments is not None and config.STATS_BACKFILL_INTERVAL:
+        backfill = asyncio.create_task(payments.run_stats_backfill(config.STATS_BACKFILL_INTERVAL))
+    try:
+        yield
+    finally:
+        if backfill is not None:
+            backfill.cancel()
+            await asyncio.gather(backfill, return_exceptions=True)
+        await shutdown()
+
+
+async def shutdown():
+    """Stops taking queued work, flushes what's buffered, then closes the stores and the HTTP pool"""
+    if webhooks is not None:
+        await webhook_queue.stop()
+        if webhooks.batcher is not None:
+            await webhooks.batcher.close()
+        await webhooks.deduplicator.close()
+    if auth is not None:
+        await auth.user_store.close()
+    await stats_store.close()
+    gateway = loaded_gateway()
+    if gateway is not None:
+        await gateway.close_http_client()
+    await http_client.close_session()
+    logger.info("Worker stopped", extra={"pid": os.getpid()})
+    log.stop_logging()
+
 
 # Initialisation
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+if auth is not None:
+    app.add_middleware(auth.UploadLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -35,13 +118,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_credentials=True
 )
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(log.RequestContextMiddleware)
 
 # Importing Prefixes
-app.include_router(auth)
-app.include_router(payments)
-app.include_router(customer)
-app.include_router(products)
-app.include_router(webhooks)
+for name, module in routers.items():
+    app.include_router(getattr(module, name))
 
 
 @app.get("/")
@@ -49,5 +131,21 @@ async def read_root():
     return {"status": 200, "message": "Success"}
 
 
+@app.get("/stripe/gateway")
+async def read_stripe_gateway():
+    # Imported on first use, so processes serving only webhooks never load the Stripe SDK
+    import stripe_gateway
+    return stripe_gateway.stats()
+
+
+@app.get("/metrics")
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+import_seconds = time.perf_counter() - _import_started
+
+
 if __name__ == "__main__":
-    uvicorn.run("app:app", port=4242, reload=True)
+    # Development only; `python server.py` is the production entry point
+    uvicorn.run("app:app", host=config.SERVER_HOST, port=config.SERVER_PORT, reload=True)
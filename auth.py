@@ -1,16 +1,26 @@
+import asyncio
 import datetime
 import json
+import logging
+import os
+import time
+import uuid
 from typing import Optional, Annotated
 
+import httpx
 import stripe
 
 # FastAPI
 from fastapi import APIRouter, UploadFile, File, Form
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from stripe import InvalidRequestError
 
 # Directory Modules
-from Resources.validators import validate_password
+import config
+import stripe_gateway
+from Resources.validators import check_if_user_exists, validate_password
+from user_store import user_store
 from models import (
     StripeSignUpObject,
     AccountUpdateBusinessProfileObject
@@ -19,8 +29,10 @@ from models import (
 # Initialisation
 auth = APIRouter(prefix="/auth", tags=["auth"])
 
+logger = logging.getLogger(__name__)
 
-def create_token(business_type: str, fname: str, lname: str, tos: bool):
+
+async def create_token(business_type: str, fname: str, lname: str, tos: bool):
     """
     :param business_type:
     :param fname:
@@ -28,7 +40,7 @@ def create_token(business_type: str, fname: str, lname: str, tos: bool):
     :param tos:
     :return: Token: stripe._token.Token
     """
-    user_token = stripe.Token.create(
+    user_token = await stripe_gateway.call(stripe.Token.create_async,
         account={
             "business_type": business_type,
             "individual": {"first_name": fname, "last_name": lname},
@@ -38,13 +50,13 @@ def create_token(business_type: str, fname: str, lname: str, tos: bool):
     return user_token
 
 
-def create_account(email: str, token):
+async def create_account(email: str, token):
     """
     :param email:
     :param token:
     :return: Token: stripe._account.Account
     """
-    account = stripe.Account.create(
+    account = await stripe_gateway.call(stripe.Account.create_async,
         email=email,
         controller={
             "fees": {"payer": "application"},
@@ -61,72 +73,249 @@ def create_account(email: str, token):
     return account
 
 
+async def upload_file_size(upload: UploadFile) -> int:
+    if upload.size is None:
+        # UploadFile.seek only takes an offset from the start
+        upload.size = await run_in_threadpool(upload.file.seek, 0, os.SEEK_END)
+        await upload.seek(0)
+    return upload.size
+
+
+class UploadLimitMiddleware:
+    """
+    Turns away /auth/update-user bodies over MAX_UPLOAD_REQUEST_BYTES before they're spooled
+    to disk: up front from Content-Length, or as soon as a chunked body passes the limit
+    """
+    PATHS = ("/auth/update-user",)
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.PATHS:
+            return await self.app(scope, receive, send)
+
+        limit = config.MAX_UPLOAD_REQUEST_BYTES
+        too_large = JSONResponse(status_code=413, content={"message": "Error", "error": f"File must be at most {config.MAX_UPLOAD_BYTES} bytes"})
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            return await too_large(scope, receive, send)
+
+        received, rejected = 0, False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Answer now, then have the form parser see a disconnect and give up
+                    rejected = True
+                    await too_large(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+
+async def upload_account_document(upload: UploadFile, stripe_account: str = None) -> dict:
+    """
+    Streams an uploaded file to Stripe's Files API as a multipart body, chunk by chunk, straight
+    from the request's spooled temp file. Reads happen off the event loop and at most
+    UPLOAD_CHUNK_BYTES of the document is held in memory at once.
+    :param upload: [UploadFile]
+    :param stripe_account: [str] - connected account to upload on behalf of
+    :return: File object as a dict
+    """
+    boundary = uuid.uuid4().hex
+    filename = (upload.filename or "document").replace('"', "")
+    head = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\naccount_requirement\r\n'
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: {upload.content_type or "application/octet-stream"}\r\n\r\n'
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        await upload.seek(0)
+        while chunk := await upload.read(config.UPLOAD_CHUNK_BYTES):
+            yield chunk
+        yield tail
+
+    headers = {
+        "Authorization": f"Bearer {stripe.api_key}",
+        "Stripe-Version": stripe.api_version,
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + await upload_file_size(upload) + len(tail)),
+    }
+    if stripe_account is not None:
+        headers["Stripe-Account"] = stripe_account
+
+    # Through the Stripe pool, so uploads reuse its connections
+    client = stripe_gateway.open_http_client().client
+    timeout = httpx.Timeout(None, connect=config.STRIPE_CONNECT_TIMEOUT, read=60)
+    try:
+        response = await client.post(f"{stripe.upload_api_base}/v1/files", content=body(), headers=headers, timeout=timeout)
+    except httpx.TransportError as e:
+        # Raised as the SDK would, so the gateway retries it
+        raise stripe.APIConnectionError(f"File upload failed: {e!r}")
+    try:
+        content = response.json()
+    except ValueError:
+        content = {}
+    if response.status_code >= 400:
+        # Raised as the SDK would, so the gateway retries 429s and 5xxs
+        message = content.get("error", {}).get("message", response.reason_phrase)
+        if response.status_code == 429:
+            raise stripe.RateLimitError(message, http_status=response.status_code)
+        if response.status_code >= 500:
+            raise stripe.APIError(message, http_status=response.status_code)
+        raise InvalidRequestError(message, content.get("error", {}).get("param"), http_status=response.status_code)
+    return content
+
+
 @auth.post('/signup')
 async def signup(user: StripeSignUpObject):
     """
     :param user:
     :return:
+    -   200, Successfully created user
+    -   409, Password too weak, or the email already has an account
+    -   500, Stripe error
+    -   503, User store unavailable
     """
-    print(1)
     # Note: Send email confirmation for security
     try:
         validate_password(user.password)
     except ValueError as e:
         return JSONResponse(status_code=409, content={"message": str(e)})
 
+    # Duplicates are turned away here, before any Stripe call. The claim holds the email
+    # while the account is created, so a concurrent signup for it is turned away too
+    user_id = None
+    if user_store.enabled:
+        try:
+            async with user_store.acquire() as conn:
+                if not await check_if_user_exists(conn, user.email):
+                    user_id = await user_store.claim(conn, user.email)
+        except Exception as e:
+            logger.exception("User lookup failed")
+            return JSONResponse(status_code=503, content={"message": "Service unavailable", "type": f"{type(e)}", "detail": str(e)})
+        if user_id is None:
+            return JSONResponse(status_code=409, content={"message": "An account with this email already exists"})
+
     try:
-        print(2)
-        token = create_token(user.business_type, user.first_name, user.last_name, user.tos_shown_and_accepted)
-        print(3)
-        account = create_account(user.email, token)
-        print(4)
-        return JSONResponse(status_code=200, content={
-            "message": "Successfully created user", 'account': {'account': account['id']}
-        })
+        token = await create_token(user.business_type, user.first_name, user.last_name, user.tos_shown_and_accepted)
+        logger.debug("Created account token", extra={"step": "create_token"})
+        account = await create_account(user.email, token)
+        logger.debug("Created connected account", extra={"step": "create_account", "account": account['id']})
     except Exception as e:
-        print(5)
-        print(f"{type(e)} - {str(e)}")
+        logger.exception("Signup failed")
+        if user_id is not None:
+            await user_store.release(user_id)
         return JSONResponse(status_code=500, content={"message": "Internal server error", "type": f"{type(e)}", "detail": str(e)})
 
+    if user_id is not None:
+        try:
+            await user_store.set_account(user_id, account['id'])
+        except Exception:
+            # The account exists, so the signup stands, but once the claim lapses the email can sign up
+            # again. Logged with both ids so the row can be completed by hand
+            logger.exception("Failed to record connected account after retries",
+                             extra={"account": account['id'], "user_id": user_id})
+    return JSONResponse(status_code=200, content={
+        "message": "Successfully created user", 'account': {'account': account['id']}
+    })
 
-@auth.post("/update-user")
-async def update_user(update_bank_info: Annotated[str, Form(...)] = None, update_individual_request: Annotated[str, Form(...)] = None, individual_file: Annotated[bytes | UploadFile, File()] = None, update_business_profile_request: Optional[AccountUpdateBusinessProfileObject] = None):
-    try:
-        if update_business_profile_request is not None:
-            # Sending docs off to stripe
-            await stripe.Account.modify_async(
-                stripe_account=update_business_profile_request.stripe_account,
-                business_profile={'url': update_business_profile_request.url, 'mcc': update_business_profile_request.industry},
-            )
 
-        if update_individual_request is not None:
-            # Reading and downloading the file, before sending off to stripe
-            fbytes = await individual_file.read()
-            file_path = "temp/{}".format(individual_file.filename)
+async def update_business_profile(request: AccountUpdateBusinessProfileObject):
+    await stripe_gateway.call(stripe.Account.modify_async,
+        stripe_account=request.stripe_account,
+        business_profile={'url': request.url, 'mcc': request.industry},
+    )
 
-            with open(file_path, "wb") as temp_file:
-                temp_file.write(fbytes)
-            with open(file_path, 'rb') as fp:
-                file_token = await stripe.File.create_async(file=fp, purpose='account_requirement')
 
-            individual_request_data = json.loads(update_individual_request)
+async def update_individual(update_individual_request: str, individual_file: UploadFile):
+    individual_request_data = json.loads(update_individual_request)
+    file_token = await stripe_gateway.call(
+        upload_account_document, individual_file, stripe_account=individual_request_data['stripe_account']
+    )
 
-            individual_request_data['verification'] = {'document': {'front': file_token['id']}}
-            token = await stripe.Token.create_async(account={"individual": individual_request_data['individual']})
-            await stripe.Account.modify_async(account_token=token, stripe_account=individual_request_data['stripe_account'],)
+    individual_request_data['individual']['verification'] = {'document': {'front': file_token['id']}}
+    token = await stripe_gateway.call(stripe.Token.create_async, account={"individual": individual_request_data['individual']})
+    await stripe_gateway.call(stripe.Account.modify_async, account_token=token['id'], stripe_account=individual_request_data['stripe_account'])
 
-        if update_bank_info is not None:
-            bank_dict = json.loads(update_bank_info)
-            stripe_account = bank_dict['stripe_account']
 
-            del bank_dict['stripe_account']
-            bank_token = await stripe.Token.create_async(bank_account=bank_dict)
+async def update_bank_account(update_bank_info: str):
+    bank_dict = json.loads(update_bank_info)
+    stripe_account = bank_dict['stripe_account']
 
-            await stripe.Account.modify_async(stripe_account=stripe_account, external_account=bank_token['id'])
+    del bank_dict['stripe_account']
+    bank_token = await stripe_gateway.call(stripe.Token.create_async, bank_account=bank_dict)
 
-        return JSONResponse(status_code=200, content={"message": 'Successfully updated account', 'time': datetime.datetime.now().timestamp()})
+    await stripe_gateway.call(stripe.Account.modify_async, stripe_account=stripe_account, external_account=bank_token['id'])
+
+
+async def run_branch(coro) -> dict:
+    """
+    :return: the branch's status and duration; errors are reported rather than raised
+    """
+    start = time.perf_counter()
+    result = {"status": "succeeded"}
+    try:
+        await coro
     except InvalidRequestError as e:
-        return JSONResponse(status_code=500, content={"message": "Error", 'error': f"{str(e).split(":")[1]}"})
+        result = {"status": "failed", "error": e.user_message or str(e)}
     except Exception as e:
-        print(f"{type(e)} - {str(e)}")
-        return JSONResponse(status_code=500, content={"message": "Error", "error": f"{str(e)}"})
+        logger.exception("Account update branch failed")
+        result = {"status": "failed", "error": str(e)}
+    result["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return result
+
+
+@auth.post("/update-user")
+async def update_user(update_bank_info: Annotated[str, Form(...)] = None, update_individual_request: Annotated[str, Form(...)] = None, individual_file: Annotated[UploadFile, File()] = None, update_business_profile_request: Optional[AccountUpdateBusinessProfileObject] = None):
+    """
+    The business profile, individual/KYC and bank account updates touch separate parts of the
+    account, so whichever were sent run concurrently. One failing doesn't stop or undo the others.
+    :return:
+    -   200, Every requested update succeeded
+    -   207, Some failed, see 'branches'
+    -   500, All failed
+    """
+    if individual_file is not None and await upload_file_size(individual_file) > config.MAX_UPLOAD_BYTES:
+        await individual_file.close()
+        return JSONResponse(status_code=413, content={"message": "Error", "error": f"File must be at most {config.MAX_UPLOAD_BYTES} bytes"})
+
+    branches = {}
+    if update_business_profile_request is not None:
+        branches['business_profile'] = update_business_profile(update_business_profile_request)
+    if update_individual_request is not None:
+        branches['individual'] = update_individual(update_individual_request, individual_file)
+    if update_bank_info is not None:
+        branches['bank_account'] = update_bank_account(update_bank_info)
+
+    try:
+        results = dict(zip(branches, await asyncio.gather(*(run_branch(coro) for coro in branches.values()))))
+    finally:
+        # Deletes the spooled temp file behind the upload
+        if individual_file is not None:
+            await individual_file.close()
+
+    failed = [name for name, result in results.items() if result['status'] == 'failed']
+    if not failed:
+        status_code, message = 200, 'Successfully updated account'
+    elif len(failed) < len(results):
+        status_code, message = 207, 'Partially updated account'
+    else:
+        status_code, message = 500, 'Error'
+    return JSONResponse(status_code=status_code, content={
+        "message": message, 'time': datetime.datetime.now().timestamp(), 'branches': results
+    })
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+def summarise(latencies: list, elapsed: float) -> dict:
+    """
+    :param latencies: [list] - request latencies in seconds
+    :param elapsed: [float] - wall-clock duration of the run in seconds
+    :return: throughput and p50/p95/p99 in milliseconds
+    """
+    if not latencies:
+        return {"requests": 0, "throughput": 0}
+
+    ordered = sorted(latencies)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {
+        "requests": len(ordered),
+        "throughput": round(len(ordered) / elapsed, 2),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+        "p50_ms": round(pick(0.50), 2),
+        "p95_ms": round(pick(0.95), 2),
+        "p99_ms": round(pick(0.99), 2),
+    }
+
+
+async def drive(client, method: str, url: str, payload_factory, concurrency: int, duration: float) -> dict:
+    """
+    Hits `url` from `concurrency` looping workers for `duration` seconds.
+    `payload_factory` returns either a JSON-able object or a (raw body, headers) tuple.
+    """
+    latencies, errors, statuses = [], 0, Counter()
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            payload = payload_factory()
+            start = time.perf_counter()
+            if isinstance(payload, tuple):
+                response = await client.request(method, url, content=payload[0], headers=payload[1])
+            else:
+                response = await client.request(method, url, json=payload)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] += 1
+            if response.status_code >= 500:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {**summarise(latencies, time.perf_counter() - start), "errors": errors, "statuses": dict(statuses)}
+
+
+def invoice_line(n: int) -> dict:
+    return {
+        "id": f"il_bench{n:010d}", "object": "line_item", "amount": 1000, "amount_excluding_tax": 1000,
+        "currency": "gbp", "description": f"1 x Bench product {n}", "discount_amounts": [], "discountable": True,
+        "discounts": [], "invoice": "in_bench", "livemode": False, "metadata": {},
+        "period": {"end": 1700000000, "start": 1700000000},
+        "price": {
+            "id": f"price_bench{n:010d}", "object": "price", "active": True, "billing_scheme": "per_unit",
+            "created": 1700000000, "currency": "gbp", "livemode": False, "metadata": {}, "product": f"prod_bench{n:010d}",
+            "recurring": None, "tax_behavior": "unspecified", "type": "one_time", "unit_amount": 1000, "unit_amount_decimal": "1000",
+        },
+        "proration": False, "quantity": 1, "tax_amounts": [], "tax_rates": [], "type": "invoiceitem",
+    }
+
+
+def stripe_invoice_event(lines: int = 100, event_type: str = "invoice.paid", n: int = 0) -> bytes:
+    """
+    An invoice event shaped like Stripe's, with the key order Stripe uses
+    :param lines: [int] - line items on the invoice, which dominate the payload size
+    :return: raw JSON body
+    """
+    invoice = {
+        "id": f"in_bench{n:010d}", "object": "invoice", "account_country": "GB", "account_name": "Bench",
+        "amount_due": 1000 * lines, "amount_paid": 1000 * lines, "amount_remaining": 0, "attempt_count": 1,
+        "attempted": True, "auto_advance": False, "billing_reason": "manual", "collection_method": "send_invoice",
+        "created": 1700000000, "currency": "gbp", "customer": "cus_bench", "customer_email": "bench@example.com",
+        "customer_name": "Bench", "due_date": 1700864000, "hosted_invoice_url": "https://invoice.stripe.com/i/bench",
+        "lines": {"object": "list", "data": [invoice_line(i) for i in range(lines)], "has_more": False,
+                  "total_count": lines, "url": f"/v1/invoices/in_bench{n:010d}/lines"},
+        "livemode": False, "metadata": {}, "number": f"BENCH-{n:04d}", "paid": True, "status": "paid",
+        "status_transitions": {"finalized_at": 1700000000, "paid_at": 1700000000},
+        "subtotal": 1000 * lines, "total": 1000 * lines,
+    }
+    return json.dumps({
+        "id": f"evt_bench{n:012d}", "object": "event", "account": "acct_bench", "api_version": "2024-06-20",
+        "created": 1700000000, "data": {"object": invoice}, "livemode": False, "pending_webhooks": 1,
+        "request": {"id": None, "idempotency_key": None}, "type": event_type,
+    }).encode()
+
+
+class BackgroundServer:
+    """
+    Serves an aiohttp handler from a background thread with its own event loop, so
+    the fake's own work never competes with the service being measured.
+
+    Every request waits `latency` seconds (plus up to `jitter`), and `error_rate` of
+    them are answered by `error_response` instead of `handle`.
+    """
+    def __init__(self, latency: float, host: str, port: int, error_rate: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        raise NotImplementedError
+
+    def error_response(self) -> web.Response:
+        return web.json_response({"error": "injected"}, status=500)
+
+    async def _dispatch(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return self.error_response()
+        return await self.handle(request)
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            app = web.Application(client_max_size=64 * 1024 ** 2)
+            app.router.add_route("*", "/{tail:.*}", self._dispatch)
+            self._runner = web.AppRunner(app, access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            self._loop.run_until_complete(web.TCPSite(self._runner, self.host, self.port).start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "injected_errors": self.errors}
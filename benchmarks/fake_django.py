@@ -0,0 +1,37 @@
+"""
+A stand-in for the Django backend that webhook events are forwarded to.
+
+Accepts single events and batches (JSON arrays) on any path. With `partial_failures`
+set, injected errors on a batch are reported per item as {"failed": [indexes]}
+rather than failing the whole request, which is what the batcher retries on.
+Start the service with DJANGO_URL pointing at `server.url`.
+"""
+import json
+import random
+
+from aiohttp import web
+
+from benchmarks.common import BackgroundServer
+
+
+class FakeDjango(BackgroundServer):
+    def __init__(self, latency: float = 0.02, host: str = "127.0.0.1", port: int = 12112,
+                 error_rate: float = 0.0, jitter: float = 0.0, partial_failures: bool = False):
+        # Batch failures are decided per item in handle(), not for the whole request
+        super().__init__(latency, host, port, 0.0 if partial_failures else error_rate, jitter)
+        self.item_error_rate = error_rate if partial_failures else 0.0
+        self.events = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = json.loads(await request.read() or b"null")
+        if not isinstance(body, list):
+            self.events += 1
+            return web.json_response({"received": 1})
+
+        failed = [i for i in range(len(body)) if self.item_error_rate and random.random() < self.item_error_rate]
+        self.errors += len(failed)
+        self.events += len(body) - len(failed)
+        return web.json_response({"received": len(body) - len(failed), "failed": failed})
+
+    def stats(self) -> dict:
+        return {**super().stats(), "events": self.events}
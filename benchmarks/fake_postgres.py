@@ -0,0 +1,268 @@
+"""
+A stand-in for the Postgres server behind user_store, used by the benchmark scripts.
+
+Speaks enough of the v3 wire protocol for asyncpg: trust authentication, simple
+queries, and the extended protocol's Parse/Describe/Bind/Execute/Sync that prepared
+statements use. It understands only user_store's own statements, answering them
+from an in-memory table after `latency` seconds. Inside a transaction they see an
+empty table and change nothing: user_store only opens one to prepare its
+statements, and always rolls it back. Start the service with DATABASE_URL set
+to `server.dsn`.
+"""
+import asyncio
+import itertools
+import struct
+import threading
+import time
+
+
+SSL_REQUEST = 80877103
+GSSENC_REQUEST = 80877104
+
+TEXT, INT4, INT8, FLOAT8 = 25, 23, 20, 701
+
+
+def message(kind: bytes, payload: bytes = b"") -> bytes:
+    return kind + struct.pack("!i", len(payload) + 4) + payload
+
+
+def cstring(value: str) -> bytes:
+    return value.encode() + b"\0"
+
+
+def read_cstring(data: bytes, offset: int) -> tuple:
+    end = data.index(b"\0", offset)
+    return data[offset:end].decode(), end + 1
+
+
+def encode_value(value, oid: int, binary: bool) -> bytes:
+    if not binary:
+        return str(value).encode()
+    if oid == INT4:
+        return struct.pack("!i", value)
+    if oid == INT8:
+        return struct.pack("!q", value)
+    return str(value).encode()
+
+
+def decode_value(raw: bytes, oid: int, binary: bool):
+    if raw is None or oid == TEXT or not binary:
+        return raw.decode() if raw is not None and oid == TEXT else raw
+    if oid == INT8:
+        return struct.unpack("!q", raw)[0]
+    if oid == FLOAT8:
+        return struct.unpack("!d", raw)[0]
+    return raw
+
+
+class UsersTable:
+    """In-memory users table, with the same claim semantics as the SQL in user_store"""
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self.by_email = {}
+        self.by_id = {}
+
+    def held(self, row: dict, ttl: float) -> bool:
+        return row["stripe_account"] is not None or time.monotonic() - row["created_at"] < ttl
+
+    def find_user(self, email: str, ttl: float) -> tuple:
+        row = self.by_email.get(email)
+        return ([(1,)] if row is not None and self.held(row, ttl) else []), "SELECT"
+
+    def claim_user(self, email: str, ttl: float) -> tuple:
+        row = self.by_email.get(email)
+        if row is None:
+            row = {"id": next(self._ids), "email": email, "stripe_account": None}
+            self.by_email[email] = self.by_id[row["id"]] = row
+        elif self.held(row, ttl):
+            return [], "INSERT 0 0"
+        row["created_at"] = time.monotonic()
+        return [(row["id"],)], "INSERT 0 1"
+
+    def set_account(self, user_id: int, stripe_account: str) -> tuple:
+        row = self.by_id.get(user_id)
+        if row is not None:
+            row["stripe_account"] = stripe_account
+        return [], f"UPDATE {int(row is not None)}"
+
+    def release_user(self, user_id: int) -> tuple:
+        row = self.by_id.get(user_id)
+        if row is None or row["stripe_account"] is not None:
+            return [], "DELETE 0"
+        del self.by_id[user_id], self.by_email[row["email"]]
+        return [], "DELETE 1"
+
+
+class FakePostgres:
+    def __init__(self, latency: float = 0.0005, host: str = "127.0.0.1", port: int = 15432):
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.table = UsersTable()
+        self.queries = 0
+        self.connections = 0
+        self.statements = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def dsn(self) -> str:
+        return f"postgresql://bench@{self.host}:{self.port}/bench?sslmode=disable"
+
+    async def _startup(self, reader, writer) -> bool:
+        while True:
+            length, = struct.unpack("!i", await reader.readexactly(4))
+            body = await reader.readexactly(length - 4)
+            code, = struct.unpack("!i", body[:4])
+            if code in (SSL_REQUEST, GSSENC_REQUEST):
+                writer.write(b"N")
+                continue
+            if code >> 16 != 3:
+                return False
+            break
+        reply = message(b"R", struct.pack("!i", 0))
+        for name, value in (("server_version", "16.0"), ("server_encoding", "UTF8"), ("client_encoding", "UTF8"),
+                            ("DateStyle", "ISO, MDY"), ("integer_datetimes", "on"), ("standard_conforming_strings", "on")):
+            reply += message(b"S", cstring(name) + cstring(value))
+        reply += message(b"K", struct.pack("!ii", self.connections, 0)) + message(b"Z", b"I")
+        writer.write(reply)
+        return True
+
+    def _row_description(self, columns) -> bytes:
+        if not columns:
+            return message(b"n")
+        fields = b"".join(
+            cstring(name) + struct.pack("!ihihih", 0, 0, oid, 8 if oid == INT8 else 4, -1, 0) for name, oid in columns
+        )
+        return message(b"T", struct.pack("!h", len(columns)) + fields)
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        prepared, portals = {}, {}
+        failed = in_transaction = False
+        try:
+            if not await self._startup(reader, writer):
+                return
+            while True:
+                kind = await reader.readexactly(1)
+                length, = struct.unpack("!i", await reader.readexactly(4))
+                body = await reader.readexactly(length - 4)
+
+                if kind == b"X":
+                    return
+                if kind == b"S":
+                    failed = False
+                    writer.write(message(b"Z", b"T" if in_transaction else b"I"))
+                    await writer.drain()
+                    continue
+                if failed or kind == b"H":
+                    # After an error, everything up to the next Sync is skipped
+                    continue
+
+                if kind == b"Q":
+                    # Schema setup, transaction control and the pool's reset query; nothing to do but acknowledge
+                    self.queries += 1
+                    query = read_cstring(body, 0)[0].strip().upper()
+                    if query.startswith("BEGIN"):
+                        in_transaction = True
+                    elif query.startswith(("ROLLBACK", "COMMIT")):
+                        in_transaction = False
+                    writer.write(message(b"C", cstring("OK")) + message(b"Z", b"T" if in_transaction else b"I"))
+                elif kind == b"P":
+                    name, offset = read_cstring(body, 0)
+                    query, _ = read_cstring(body, offset)
+                    if query not in self.statements:
+                        writer.write(message(b"E", b"SERROR\0C42601\0M" + cstring(f"fake_postgres can't run: {query.strip()[:60]}") + b"\0"))
+                        failed = True
+                        continue
+                    prepared[name] = self.statements[query]
+                    writer.write(message(b"1"))
+                elif kind == b"D":
+                    target, name = body[:1], read_cstring(body, 1)[0]
+                    params, columns, _ = prepared[name] if target == b"S" else portals[name][0]
+                    if target == b"S":
+                        writer.write(message(b"t", struct.pack("!h", len(params)) + b"".join(struct.pack("!i", oid) for oid in params)))
+                    writer.write(self._row_description(columns))
+                elif kind == b"B":
+                    portal, offset = read_cstring(body, 0)
+                    name, offset = read_cstring(body, offset)
+                    statement = prepared[name]
+                    n, = struct.unpack_from("!h", body, offset)
+                    formats = struct.unpack_from(f"!{n}h", body, offset + 2)
+                    offset += 2 + 2 * n
+                    count, = struct.unpack_from("!h", body, offset)
+                    offset += 2
+                    values = []
+                    for i in range(count):
+                        size, = struct.unpack_from("!i", body, offset)
+                        offset += 4
+                        raw = None if size < 0 else body[offset:offset + size]
+                        offset += max(size, 0)
+                        binary = (formats[i] if len(formats) > 1 else formats[0] if formats else 0) == 1
+                        values.append(decode_value(raw, statement[0][i], binary))
+                    n, = struct.unpack_from("!h", body, offset)
+                    result_formats = struct.unpack_from(f"!{n}h", body, offset + 2)
+                    portals[portal] = (statement, values, result_formats)
+                    writer.write(message(b"2"))
+                elif kind == b"E":
+                    (_, columns, handler), values, result_formats = portals[read_cstring(body, 0)[0]]
+                    self.queries += 1
+                    await asyncio.sleep(self.latency)
+                    rows, tag = ([], "OK") if in_transaction else handler(*values)
+                    for row in rows:
+                        cells = b""
+                        for i, ((_, oid), value) in enumerate(zip(columns, row)):
+                            binary = (result_formats[i] if len(result_formats) > 1 else result_formats[0] if result_formats else 0) == 1
+                            encoded = encode_value(value, oid, binary)
+                            cells += struct.pack("!i", len(encoded)) + encoded
+                        writer.write(message(b"D", struct.pack("!h", len(row)) + cells))
+                    writer.write(message(b"C", cstring(tag)))
+                elif kind == b"C":
+                    target, name = body[:1], read_cstring(body, 1)[0]
+                    (prepared if target == b"S" else portals).pop(name, None)
+                    writer.write(message(b"3"))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        # Imported here rather than at the top so that config, which user_store imports,
+        # reads the environment the caller set up after creating the server
+        import user_store
+
+        # statement -> (parameter oids, result columns as (name, oid), handler)
+        self.statements = {
+            user_store.FIND_USER: ((TEXT, FLOAT8), (("?column?", INT4),), self.table.find_user),
+            user_store.CLAIM_USER: ((TEXT, FLOAT8), (("id", INT8),), self.table.claim_user),
+            user_store.SET_ACCOUNT: ((INT8, TEXT), (), self.table.set_account),
+            user_store.RELEASE_USER: ((INT8,), (), self.table.release_user),
+        }
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        return {"queries": self.queries, "connections": self.connections, "users": len(self.table.by_email)}
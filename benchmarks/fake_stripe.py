@@ -0,0 +1,75 @@
+"""
+A minimal stand-in for the Stripe REST API, used by the benchmark scripts.
+
+Every request sleeps for `latency` seconds before answering with a plausible
+object for the resource in the path, so the service can be driven without
+touching Stripe. Point the SDK at it with `stripe.api_base = stripe.upload_api_base = server.url`,
+or start the service with STRIPE_API_BASE set to it.
+
+Injected errors are Stripe-shaped 500s, or 429s when `rate_limit` is set, so they
+exercise the gateway's retries.
+"""
+import itertools
+import time
+
+from aiohttp import web
+
+from benchmarks.common import BackgroundServer
+
+
+PREFIXES = {
+    "accounts": "acct",
+    "customers": "cus",
+    "files": "file",
+    "invoiceitems": "ii",
+    "invoices": "in",
+    "prices": "price",
+    "products": "prod",
+    "tokens": "tok",
+}
+
+
+class FakeStripe(BackgroundServer):
+    def __init__(self, latency: float = 0.05, host: str = "127.0.0.1", port: int = 12111,
+                 error_rate: float = 0.0, jitter: float = 0.0, rate_limit: bool = False):
+        super().__init__(latency, host, port, error_rate, jitter)
+        self.rate_limit = rate_limit
+        self._ids = itertools.count(1)
+
+    def _new_id(self, resource: str) -> str:
+        return f"{PREFIXES.get(resource, resource[:4])}_{next(self._ids):014d}"
+
+    def error_response(self) -> web.Response:
+        if self.rate_limit:
+            return web.json_response({"error": {"type": "invalid_request_error", "code": "rate_limit", "message": "Too many requests"}}, status=429)
+        return web.json_response({"error": {"type": "api_error", "message": "Injected failure"}}, status=500)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        parts = request.path.strip("/").split("/")[1:]  # drop the 'v1'
+        if parts and parts[0] == "issuing":
+            parts = parts[1:]
+        resource = parts[0] if parts else ""
+
+        if resource == "balance":
+            return web.json_response({"object": "balance", "available": [{"amount": 0, "currency": "usd"}]})
+
+        if request.method == "GET" and parts[-1:] == ["search"]:
+            return web.json_response({"object": "search_result", "data": [], "has_more": False, "url": request.path})
+
+        if request.method == "GET" and len(parts) == 1:
+            # Prices are looked up by product, so always have one to hand back
+            data = [{"id": self._new_id("prices"), "object": "price"}] if resource == "prices" else []
+            return web.json_response({"object": "list", "data": data, "has_more": False, "url": request.path})
+
+        form = await request.post() if request.method == "POST" else {}
+        obj = {
+            "id": parts[1] if len(parts) > 1 else self._new_id(resource),
+            "object": resource.rstrip("s"),
+            "created": int(time.time()),
+            **{k: v for k, v in form.items() if "[" not in k and isinstance(v, str)},
+        }
+        if resource == "invoiceitems":
+            obj["amount"] = int(obj.get("unit_amount", 0) or 0)
+        if request.method == "DELETE":
+            obj["deleted"] = True
+        return web.json_response(obj)
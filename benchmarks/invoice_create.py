@@ -0,0 +1,71 @@
+"""
+Wall-clock time per /payments/invoice/create for each of the four invoice
+builders, against the fake Stripe API with a fixed latency per call.
+
+    python -m benchmarks.invoice_create --latency 0.1 --requests 20
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import stripe
+
+from app import app
+from benchmarks.common import summarise
+from benchmarks.fake_stripe import FakeStripe
+
+
+BASE = {
+    "unit_amount": 1000,
+    "currency": "gbp",
+    "due_date": "2099-01-01",
+    "stripe_account": "acct_bench",
+    "draft": True,
+}
+
+STRATEGIES = {
+    "new_product_and_customer": {
+        "new_product": {"name": "Bench product"},
+        "new_customer": {"name": "Bench", "email": "bench@example.com"},
+    },
+    "existing_customer": {"new_product": {"name": "Bench product"}, "customer_id": "cus_bench"},
+    "product_id": {"product_id": "prod_bench", "new_customer": {"name": "Bench", "email": "bench@example.com"}},
+    "premade_entities": {"product_id": "prod_bench", "customer_id": "cus_bench"},
+}
+
+
+async def run(args) -> dict:
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name, fields in STRATEGIES.items():
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                sent = time.perf_counter()
+                response = await client.post("/payments/invoice/create", json={**BASE, **fields})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - sent)
+            results[name] = summarise(latencies, time.perf_counter() - start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.1, help="Fake Stripe latency in seconds")
+    parser.add_argument("--requests", type=int, default=20, help="Sequential requests per strategy")
+    args = parser.parse_args()
+
+    fake = FakeStripe(latency=args.latency).start()
+    stripe.api_base = stripe.upload_api_base = fake.url
+    stripe.api_key = stripe.api_key or "sk_test_bench"
+    try:
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Micro-benchmark for Stripe-Signature verification on raw webhook bodies.
+
+Times the accept path and each reject path for a small event and a large invoice
+event, next to the SDK's stripe.WebhookSignature.verify_header for reference, and
+prints microseconds per call as JSON.
+
+    python -m benchmarks.signature_verify --number 20000
+"""
+import argparse
+import json
+import time
+import timeit
+
+import stripe
+
+from benchmarks.common import stripe_invoice_event
+from signature import sign, verify_signature
+
+
+SECRET = "whsec_bench"
+TOLERANCE = 300
+
+
+def small_event() -> bytes:
+    return json.dumps({
+        "id": "evt_bench", "object": "event", "type": "charge.succeeded", "created": int(time.time()),
+        "data": {"object": {"id": "ch_bench", "amount_captured": 1000, "created": int(time.time())}},
+    }).encode()
+
+
+def per_call_us(fn, number: int) -> float:
+    return round(min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6, 3)
+
+
+def bench(payload: bytes, number: int) -> dict:
+    valid = sign(payload, SECRET)
+    forged = sign(payload, "whsec_wrong")
+    stale = sign(payload, SECRET, int(time.time()) - TOLERANCE - 60)
+    secrets = [SECRET]
+    text = payload.decode()
+    return {
+        "bytes": len(payload),
+        "valid_us": per_call_us(lambda: verify_signature(payload, valid, secrets, TOLERANCE), number),
+        "signature_mismatch_us": per_call_us(lambda: verify_signature(payload, forged, secrets, TOLERANCE), number),
+        "stale_timestamp_us": per_call_us(lambda: verify_signature(payload, stale, secrets, TOLERANCE), number),
+        "missing_header_us": per_call_us(lambda: verify_signature(payload, None, secrets, TOLERANCE), number),
+        "malformed_header_us": per_call_us(lambda: verify_signature(payload, "garbage", secrets, TOLERANCE), number),
+        "stripe_sdk_valid_us": per_call_us(lambda: stripe.WebhookSignature.verify_header(text, valid, SECRET, TOLERANCE), number),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000, help="Calls per timing")
+    parser.add_argument("--lines", type=int, default=100, help="Line items in the large invoice event")
+    args = parser.parse_args()
+
+    print(json.dumps({
+        "small_event": bench(small_event(), args.number),
+        "invoice_event": bench(stripe_invoice_event(args.lines), args.number // 10 or 1),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
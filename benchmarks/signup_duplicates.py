@@ -0,0 +1,123 @@
+"""
+Load test for /auth/signup's duplicate check against the Postgres stand-in.
+
+Runs the app in-process, serving only the auth router, against the fake Stripe API
+and fake Postgres, in three phases:
+    new - signups with fresh emails, which each create a Stripe account
+    duplicate - signups for emails that already have accounts, which should be
+        turned away with a 409 by the local lookup without any Stripe call
+    race - bursts of concurrent signups for one email, of which only one should
+        get through
+and prints the latency of each phase and the Stripe calls it made, as JSON.
+
+    python -m benchmarks.signup_duplicates --duration 10 --concurrency 20
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+
+import httpx
+
+from benchmarks.common import drive
+from benchmarks.fake_postgres import FakePostgres
+from benchmarks.fake_stripe import FakeStripe
+
+
+_ids = itertools.count()
+registered = []
+
+
+def signup_payload(email: str) -> dict:
+    return {
+        "email": email,
+        "password": "bench-pass-12!!",
+        "first_name": "Bench",
+        "last_name": "Mark",
+        "phone": "07000000000",
+        "business_type": "individual",
+        "tos_shown_and_accepted": True,
+    }
+
+
+def new_signup() -> dict:
+    email = f"bench{next(_ids)}@example.com"
+    registered.append(email)
+    return signup_payload(email)
+
+
+def duplicate_signup() -> dict:
+    # A different casing of a registered address is still the same user
+    return signup_payload(random.choice(registered).upper())
+
+
+async def race(client, emails: int, burst: int) -> dict:
+    """
+    :return: how many of each burst's concurrent signups for one email succeeded
+    """
+    async def signup(email):
+        response = await client.post("/auth/signup", json=signup_payload(email))
+        return response.status_code
+
+    succeeded = []
+    for _ in range(emails):
+        email = f"race{next(_ids)}@example.com"
+        statuses = await asyncio.gather(*(signup(email) for _ in range(burst)))
+        succeeded.append(statuses.count(200))
+    return {"emails": emails, "burst": burst, "max_succeeded_per_email": max(succeeded), "succeeded": sum(succeeded)}
+
+
+async def run(args, stripe_server) -> dict:
+    # Imported here so config picks up the overrides set in main()
+    from app import app
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name, phase in (
+                ("new", lambda: drive(client, "POST", "/auth/signup", new_signup, args.concurrency, args.duration)),
+                ("duplicate", lambda: drive(client, "POST", "/auth/signup", duplicate_signup, args.concurrency, args.duration)),
+                ("race", lambda: race(client, args.race_emails, args.race_burst)),
+            ):
+                before = stripe_server.requests
+                results[name] = {**await phase(), "stripe_calls": stripe_server.requests - before}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per phase")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--stripe-latency", type=float, default=0.1)
+    parser.add_argument("--db-latency", type=float, default=0.0002, help="Fake Postgres time per statement in seconds")
+    parser.add_argument("--race-emails", type=int, default=50)
+    parser.add_argument("--race-burst", type=int, default=10, help="Concurrent signups per email in the race phase")
+    args = parser.parse_args()
+
+    stripe_server = FakeStripe(latency=args.stripe_latency).start()
+    postgres = FakePostgres(latency=args.db_latency)
+    os.environ.update({
+        "ENABLED_ROUTERS": "auth",
+        "STRIPE_API_BASE": stripe_server.url,
+        "DATABASE_URL": postgres.dsn,
+        "STATS_BACKFILL_INTERVAL": "0",
+    })
+    os.environ.setdefault("STRIPE_API_KEY", "sk_test_bench")
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    # Signups are only limited by the fake Stripe's latency, not the live-mode rate limits
+    os.environ.setdefault("STRIPE_GLOBAL_RATE", "100000")
+    postgres.start()
+    try:
+        results = asyncio.run(run(args, stripe_server))
+        report = {"results": results, "stripe": stripe_server.stats(), "postgres": postgres.stats()}
+    finally:
+        stripe_server.stop()
+        postgres.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Load test for /auth/signup running alongside /payments/* traffic.
+
+Runs the app in-process against the fake Stripe API, first with only
+/payments/get-stats pollers and then with signups mixed in, and prints the
+latency summary of the payments traffic for both phases. With the Stripe
+calls in signup awaited properly the two p99 figures should be close.
+
+    python -m benchmarks.signup_load --latency 0.1 --duration 10
+"""
+import argparse
+import asyncio
+import itertools
+import json
+
+import httpx
+import stripe
+
+from app import app
+from benchmarks.common import drive
+from benchmarks.fake_stripe import FakeStripe
+
+
+_emails = itertools.count()
+
+
+def signup_payload() -> dict:
+    return {
+        "email": f"bench{next(_emails)}@example.com",
+        "password": "bench-pass-12!!",
+        "first_name": "Bench",
+        "last_name": "Mark",
+        "phone": "07000000000",
+        "business_type": "individual",
+        "tos_shown_and_accepted": True,
+    }
+
+
+def stats_payload() -> dict:
+    return {"stripe_account": "acct_bench"}
+
+
+async def run(args) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        baseline = await drive(client, "POST", "/payments/get-stats", stats_payload, args.pollers, args.duration)
+
+        payments, signups = await asyncio.gather(
+            drive(client, "POST", "/payments/get-stats", stats_payload, args.pollers, args.duration),
+            drive(client, "POST", "/auth/signup", signup_payload, args.signups, args.duration),
+        )
+    return {"payments_baseline": baseline, "payments_with_signups": payments, "signups": signups}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.1, help="Fake Stripe latency in seconds")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--pollers", type=int, default=20)
+    parser.add_argument("--signups", type=int, default=10)
+    args = parser.parse_args()
+
+    fake = FakeStripe(latency=args.latency).start()
+    stripe.api_base = stripe.upload_api_base = fake.url
+    stripe.api_key = stripe.api_key or "sk_test_bench"
+    try:
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
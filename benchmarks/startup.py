@@ -0,0 +1,86 @@
+"""
+Cold-start cost of importing the app, per module.
+
+Imports `app` in fresh interpreters under `python -X importtime` and reports the
+median total and the slowest modules by cumulative import time, as JSON. Run it
+with ENABLED_ROUTERS set to see what a narrower deployment saves.
+
+    python -m benchmarks.startup --runs 5 --top 15
+    ENABLED_ROUTERS=webhooks python -m benchmarks.startup
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+
+def parse_importtime(stderr: str) -> dict:
+    """
+    :param stderr: [str] - output of `-X importtime`, lines like 'import time:   self [us] | cumulative | name'
+    :return: {module: (self_us, cumulative_us)}
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def import_once(module: str) -> tuple:
+    """
+    :return: (wall seconds, {module: (self_us, cumulative_us)}) for one fresh interpreter
+    """
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env={**os.environ, "LOG_LEVEL": "CRITICAL"},
+    )
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    return elapsed, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to take the median over")
+    parser.add_argument("--top", type=int, default=15, help="Modules to list, by cumulative import time")
+    args = parser.parse_args()
+
+    walls, cumulative, own = [], defaultdict(list), defaultdict(list)
+    for _ in range(args.runs):
+        wall, modules = import_once(args.module)
+        walls.append(wall)
+        for name, (self_us, cumulative_us) in modules.items():
+            own[name].append(self_us)
+            cumulative[name].append(cumulative_us)
+
+    slowest = sorted(cumulative, key=lambda name: statistics.median(cumulative[name]), reverse=True)[:args.top]
+    print(json.dumps({
+        "module": args.module,
+        "enabled_routers": os.getenv("ENABLED_ROUTERS", "all"),
+        "runs": args.runs,
+        "wall_ms": round(statistics.median(walls) * 1000, 1),
+        "import_ms": round(statistics.median(cumulative[args.module]) / 1000, 1),
+        "modules_loaded": len(cumulative),
+        "stripe_loaded": "stripe" in cumulative,
+        "slowest": [
+            {
+                "module": name,
+                "cumulative_ms": round(statistics.median(cumulative[name]) / 1000, 1),
+                "self_ms": round(statistics.median(own[name]) / 1000, 1),
+            }
+            for name in slowest
+        ],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
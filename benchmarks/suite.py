@@ -0,0 +1,208 @@
+"""
+Benchmark suite: drives each endpoint at a fixed concurrency against the fake Stripe
+API and fake Django receiver, and prints throughput and p50/p95/p99 latency as JSON.
+
+By default the app runs in-process, with its lifespan, configured through the
+STRIPE_API_BASE and DJANGO_URL overrides. Pass --url to measure a running server
+instead; start it with the settings printed on stderr. Webhook events are signed
+with --webhook-secret, and in-process signups are checked against the Postgres
+stand-in.
+
+    python -m benchmarks.suite --concurrency 20 --duration 10 --output bench.json
+    python -m benchmarks.suite --only invoice_create get_stats --stripe-error-rate 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.common import drive
+from benchmarks.fake_django import FakeDjango
+from benchmarks.fake_postgres import FakePostgres
+from benchmarks.fake_stripe import FakeStripe
+from signature import sign
+
+
+_ids = itertools.count()
+
+# Set from --webhook-secret; the service under test must be configured with the same one
+webhook_secret = "whsec_bench"
+
+
+def invoice_payload() -> dict:
+    n = next(_ids)
+    return {
+        "unit_amount": 1000,
+        "currency": "gbp",
+        "due_date": "2099-01-01",
+        "stripe_account": f"acct_bench{n % 10}",
+        "draft": True,
+        "new_product": {"name": f"Bench product {n % 100}"},
+        "new_customer": {"name": "Bench", "email": f"bench{n % 100}@example.com"},
+    }
+
+
+def stats_payload() -> dict:
+    return {"stripe_account": f"acct_bench{next(_ids) % 50}"}
+
+
+def signup_payload() -> dict:
+    return {
+        "email": f"bench{next(_ids)}@example.com",
+        "password": "bench-pass-12!!",
+        "first_name": "Bench",
+        "last_name": "Mark",
+        "phone": "07000000000",
+        "business_type": "individual",
+        "tos_shown_and_accepted": True,
+    }
+
+
+def event(event_type: str, obj: dict) -> tuple:
+    """
+    :return: (raw body, headers) signed the way Stripe signs deliveries
+    """
+    n = next(_ids)
+    # Same key order as Stripe, with the type last
+    body = json.dumps({
+        "id": f"evt_bench{n:012d}",
+        "object": "event",
+        "account": f"acct_bench{n % 10}",
+        "created": int(time.time()),
+        "data": {"object": {"id": f"bench_{n}", "created": int(time.time()), **obj}},
+        "type": event_type,
+    }).encode()
+    return body, {"content-type": "application/json", "stripe-signature": sign(body, webhook_secret)}
+
+
+def invoice_event() -> tuple:
+    return event("invoice.paid", {"object": "invoice", "amount_paid": 1000})
+
+
+def transaction_event() -> tuple:
+    return event("charge.succeeded", {"object": "charge", "amount_captured": 1000})
+
+
+SCENARIOS = {
+    "invoice_create": ("POST", "/payments/invoice/create", invoice_payload),
+    "get_stats": ("POST", "/payments/get-stats", stats_payload),
+    "signup": ("POST", "/auth/signup", signup_payload),
+    "webhook_invoice": ("POST", "/webhooks/invoice/receive", invoice_event),
+    "webhook_transactions": ("POST", "/webhooks/transactions/receive", transaction_event),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_scenarios(client, args) -> dict:
+    results = {}
+    for name in args.only:
+        method, url, payload_factory = SCENARIOS[name]
+        results[name] = await drive(client, method, url, payload_factory, args.concurrency, args.duration)
+    return results
+
+
+async def run_in_process(args) -> dict:
+    # Imported here so config picks up the overrides set in main()
+    from app import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            results = await run_scenarios(client, args)
+        # Give the webhook workers a moment to forward what was queued
+        await asyncio.sleep(args.settle)
+    return results
+
+
+async def run_remote(args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=None, limits=limits) as client:
+        results = await run_scenarios(client, args)
+    await asyncio.sleep(args.settle)
+    return results
+
+
+def main():
+    global webhook_secret
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per scenario")
+    parser.add_argument("--url", help="Benchmark a running server instead of the app in-process")
+    parser.add_argument("--stripe-latency", type=float, default=0.05)
+    parser.add_argument("--stripe-jitter", type=float, default=0.0)
+    parser.add_argument("--stripe-error-rate", type=float, default=0.0)
+    parser.add_argument("--stripe-rate-limit", action="store_true", help="Inject 429s rather than 500s")
+    parser.add_argument("--django-latency", type=float, default=0.02)
+    parser.add_argument("--django-error-rate", type=float, default=0.0)
+    parser.add_argument("--django-partial-failures", action="store_true", help="Fail batch items rather than whole requests")
+    parser.add_argument("--webhook-secret", default=webhook_secret, help="Secret webhook events are signed with")
+    parser.add_argument("--settle", type=float, default=1.0, help="Seconds to let queued webhooks drain before reporting")
+    parser.add_argument("--output", help="Also write the report to this file")
+    args = parser.parse_args()
+    webhook_secret = args.webhook_secret
+
+    stripe_server = FakeStripe(latency=args.stripe_latency, jitter=args.stripe_jitter,
+                               error_rate=args.stripe_error_rate, rate_limit=args.stripe_rate_limit).start()
+    django_server = FakeDjango(latency=args.django_latency, error_rate=args.django_error_rate,
+                               partial_failures=args.django_partial_failures).start()
+    postgres = FakePostgres()
+    workdir = tempfile.TemporaryDirectory()
+    try:
+        if args.url:
+            print(f"Expecting {args.url} to run with STRIPE_API_BASE={stripe_server.url} "
+                  f"DJANGO_URL={django_server.url}/api STRIPE_WEBHOOK_SIGNING_SECRET={args.webhook_secret}", file=sys.stderr)
+            results = asyncio.run(run_remote(args))
+        else:
+            os.environ.update({
+                "STRIPE_API_BASE": stripe_server.url,
+                "DJANGO_URL": f"{django_server.url}/api",
+                "STRIPE_WEBHOOK_SIGNING_SECRET": args.webhook_secret,
+                "DATABASE_URL": postgres.dsn,
+                "WEBHOOK_QUEUE_PATH": os.path.join(workdir.name, "webhook_queue.db"),
+                "STATS_STORE_PATH": os.path.join(workdir.name, "stats.db"),
+                "STATS_BACKFILL_INTERVAL": "0",
+            })
+            os.environ.setdefault("STRIPE_API_KEY", "sk_test_bench")
+            os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+            postgres.start()
+            results = asyncio.run(run_in_process(args))
+
+        report = {
+            "commit": git_commit(),
+            "timestamp": int(time.time()),
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "results": results,
+            "stripe": stripe_server.stats(),
+            "django": django_server.stats(),
+        }
+        if not args.url:
+            report["postgres"] = postgres.stats()
+    finally:
+        stripe_server.stop()
+        django_server.stop()
+        postgres.stop()
+        workdir.cleanup()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Cost of getting from a raw webhook body to a dispatchable event.
+
+Compares the standard library's json.loads, the optional orjson decoder behind
+fastjson, and the raw-bytes type check that lets unhandled events skip decoding
+altogether, on invoice events of increasing size. Reports microseconds per call
+and the peak memory allocated by one call, as JSON.
+
+    python -m benchmarks.webhook_decode --number 2000
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+
+import fastjson
+from benchmarks.common import stripe_invoice_event
+from webhooks import extract_event_type
+
+
+def per_call_us(fn, number: int) -> float:
+    return round(min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6, 3)
+
+
+def peak_kib(fn) -> float:
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return round(peak / 1024, 1)
+
+
+def bench(body: bytes, number: int) -> dict:
+    decoders = {
+        "json_loads": lambda: json.loads(body),
+        f"fastjson_loads ({fastjson.BACKEND})": lambda: fastjson.loads(body),
+        "type_check_only": lambda: extract_event_type(body),
+    }
+    return {
+        "bytes": len(body),
+        **{name: {"us": per_call_us(fn, number), "peak_kib": peak_kib(fn)} for name, fn in decoders.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000, help="Calls per timing")
+    parser.add_argument("--lines", type=int, nargs="+", default=[1, 10, 100], help="Invoice sizes in line items")
+    args = parser.parse_args()
+
+    print(json.dumps({
+        "backend": fastjson.BACKEND,
+        "results": {f"invoice_{lines}_lines": bench(stripe_invoice_event(lines), args.number) for lines in args.lines},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
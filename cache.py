@@ -0,0 +1,169 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+# Directory Modules
+import config
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries also expire `ttl` seconds after being set.
+    Every operation is O(1); hit/miss counters are kept for sizing.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING or entry[0] < time.monotonic():
+            if entry is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlightCache:
+    """
+    Result cache with stale-while-revalidate. Within `ttl` a cached value is returned as is;
+    for `stale_ttl` after that it's still returned, while a refresh runs in the background.
+    Concurrent callers missing on the same key share one in-flight computation.
+    """
+    def __init__(self, ttl: float, stale_ttl: float, max_size: int):
+        self.ttl = ttl
+        self._entries = TTLCache(max_size, ttl + stale_ttl)  # key -> (fresh_until, value)
+        self._in_flight = {}
+
+    async def get(self, key, compute: Callable[[], Awaitable]):
+        """
+        :param key: hashable cache key
+        :param compute: coroutine function producing the value on a miss
+        :return: cached or freshly computed value
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            fresh_until, value = entry
+            if time.monotonic() >= fresh_until:
+                self._refresh(key, compute)
+            return value
+
+        # Shielded so one caller going away doesn't cancel the computation for the rest
+        return await asyncio.shield(self._refresh(key, compute))
+
+    def _refresh(self, key, compute) -> asyncio.Task:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._compute(key, compute))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  # background failures keep serving stale
+            self._in_flight[key] = task
+        return task
+
+    async def _compute(self, key, compute):
+        try:
+            value = await compute()
+            self._entries.set(key, (time.monotonic() + self.ttl, value))
+            return value
+        finally:
+            del self._in_flight[key]
+
+    def set(self, key, value):
+        self._entries.set(key, (time.monotonic() + self.ttl, value))
+
+    def pop(self, key):
+        self._entries.pop(key)
+
+    def stats(self) -> dict:
+        return {**self._entries.stats(), "in_flight": len(self._in_flight)}
+
+
+# (stripe_account, product_id) -> price_id. Filled by /products/create and invoice
+# creation, invalidated by price.* and product.* webhooks. Each worker process has
+# its own copy, so PRICE_CACHE_TTL bounds how stale another process can be
+price_cache = TTLCache(config.PRICE_CACHE_SIZE, config.PRICE_CACHE_TTL)
+
+# (stripe_account, email) -> customer and (stripe_account, product name) -> product, as the
+# compact dicts built below. Kept current by customer.* and product.* webhooks;
+# OBJECT_CACHE_TTL bounds how stale another worker process's copy can be
+customer_index = SingleFlightCache(config.OBJECT_CACHE_TTL, 0, config.CUSTOMER_CACHE_SIZE)
+product_index = SingleFlightCache(config.OBJECT_CACHE_TTL, 0, config.PRODUCT_CACHE_SIZE)
+
+# stripe_account -> (get-stats content, timings)
+stats_cache = SingleFlightCache(config.STATS_CACHE_TTL, config.STATS_CACHE_STALE_TTL, config.STATS_CACHE_SIZE)
+
+
+def customer_key(stripe_account: str, email: str) -> tuple:
+    # Stripe stores emails as given, but two casings of one address are the same buyer
+    return stripe_account, email.strip().lower()
+
+
+def product_key(stripe_account: str, name: str) -> tuple:
+    return stripe_account, name.strip()
+
+
+def compact_customer(customer) -> dict:
+    return {"id": customer["id"], "name": customer.get("name"), "email": customer.get("email")}
+
+
+def compact_product(product) -> dict:
+    return {"id": product["id"], "name": product.get("name"), "description": product.get("description")}
+
+
+def apply_customer_event(stripe_account: Optional[str], event_type: str, customer: dict, previous: dict = None):
+    """
+    Keeps customer_index in step with a customer.* webhook
+    :param previous: [dict] - the event's data.previous_attributes, holding the old email after a change
+    """
+    if previous and previous.get("email"):
+        customer_index.pop(customer_key(stripe_account, previous["email"]))
+    if not customer.get("email"):
+        return
+    if event_type == "customer.deleted":
+        customer_index.pop(customer_key(stripe_account, customer["email"]))
+    else:
+        customer_index.set(customer_key(stripe_account, customer["email"]), compact_customer(customer))
+
+
+def apply_product_event(stripe_account: Optional[str], event_type: str, product: dict, previous: dict = None):
+    """
+    Keeps product_index in step with a product.* webhook; archived products are dropped
+    :param previous: [dict] - the event's data.previous_attributes, holding the old name after a rename
+    """
+    if previous and previous.get("name"):
+        product_index.pop(product_key(stripe_account, previous["name"]))
+    if not product.get("name"):
+        return
+    if event_type == "product.deleted" or not product.get("active", True):
+        product_index.pop(product_key(stripe_account, product["name"]))
+    else:
+        product_index.set(product_key(stripe_account, product["name"]), compact_product(product))
@@ -1,17 +1,133 @@
 import os
 from dotenv import load_dotenv
-import stripe
 
 
 load_dotenv()
 
 # Stripe Envs
 STRIPE_WEBHOOK_SSECRET = os.getenv('STRIPE_WEBHOOK_SIGNING_SECRET')
+# Comma separated, so a secret can be rotated or several endpoints can share the receiver
+STRIPE_WEBHOOK_SECRETS = [s.strip() for s in (STRIPE_WEBHOOK_SSECRET or "").split(",") if s.strip()]
+WEBHOOK_SIGNATURE_TOLERANCE = int(os.getenv("WEBHOOK_SIGNATURE_TOLERANCE", 300))
 
+# Applied to the SDK by stripe_gateway, so importing config doesn't import stripe
 STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
-stripe.api_key = STRIPE_API_KEY
 
 STRIPE_PUBLIC_TEST_KEY = os.getenv('STRIPE_PUBLIC_TEST_KEY')
 STRIPE_SECRET_TEST_KEY = os.getenv('STRIPE_SECRET_TEST_KEY')
 
 STRIPE_BASE_URL = "https://api.stripe.com/v1/"
+
+# Points the SDK somewhere other than Stripe, e.g. the stand-in under benchmarks/
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")
+
+# Django backend that webhook events are forwarded to
+DJANGO_URL = os.getenv("DJANGO_URL", "http://127.0.0.1:8000/api")
+
+# Logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # per-logger overrides e.g. 'stripe_gateway=DEBUG,access=WARNING'
+
+# Outbound HTTP pool
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", 15))
+
+# Webhook ingestion queue
+WEBHOOK_QUEUE_BACKEND = os.getenv("WEBHOOK_QUEUE_BACKEND", "sqlite")  # sqlite | redis
+WEBHOOK_QUEUE_PATH = os.getenv("WEBHOOK_QUEUE_PATH", "webhook_queue.db")
+WEBHOOK_QUEUE_MAX_DEPTH = int(os.getenv("WEBHOOK_QUEUE_MAX_DEPTH", 10000))
+# Failed events are retried with jittered exponential backoff; with these defaults the
+# retries span roughly 20-35 minutes before the event is parked as dead. Dead events
+# stay in the queue until `python webhook_queue.py redrive`
+WEBHOOK_QUEUE_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_QUEUE_MAX_ATTEMPTS", 10))
+WEBHOOK_RETRY_BASE_DELAY = float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", 5))
+WEBHOOK_RETRY_MAX_DELAY = float(os.getenv("WEBHOOK_RETRY_MAX_DELAY", 900))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+# A claim older than this is taken to belong to a dead consumer; every process checks every interval
+WEBHOOK_QUEUE_VISIBILITY_TIMEOUT = int(os.getenv("WEBHOOK_QUEUE_VISIBILITY_TIMEOUT", 300))
+WEBHOOK_QUEUE_RECOVER_INTERVAL = float(os.getenv("WEBHOOK_QUEUE_RECOVER_INTERVAL", 30))
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Batched forwarding to Django. Each queue consumer holds up to WEBHOOK_BATCH_SIZE claimed
+# events while they wait for their batch, and acks each one once it's delivered
+WEBHOOK_BATCHING = os.getenv("WEBHOOK_BATCHING", "false").lower() == "true"
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", 50))
+WEBHOOK_BATCH_INTERVAL = float(os.getenv("WEBHOOK_BATCH_INTERVAL", 0.5))
+WEBHOOK_BATCH_MAX_RETRIES = int(os.getenv("WEBHOOK_BATCH_MAX_RETRIES", 3))
+
+# Webhook event de-duplication. Stripe retries deliveries for up to 3 days
+WEBHOOK_DEDUP_BACKEND = os.getenv("WEBHOOK_DEDUP_BACKEND", "memory")  # memory | sqlite | redis
+WEBHOOK_DEDUP_PATH = os.getenv("WEBHOOK_DEDUP_PATH", WEBHOOK_QUEUE_PATH)
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", 100000))
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", 3 * 24 * 60 * 60))
+
+# Product -> price lookups used when building invoices
+PRICE_CACHE_SIZE = int(os.getenv("PRICE_CACHE_SIZE", 10000))
+PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", 300))
+
+# Customer (by email) and product (by name) indexes per connected account
+CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", 50000))
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", 50000))
+OBJECT_CACHE_TTL = int(os.getenv("OBJECT_CACHE_TTL", 900))
+
+# /payments/invoice/bulk
+BULK_INVOICE_CONCURRENCY = int(os.getenv("BULK_INVOICE_CONCURRENCY", 10))
+BULK_INVOICE_RATE = float(os.getenv("BULK_INVOICE_RATE", 20))  # invoices started per second, across all bulk jobs
+BULK_INVOICE_MAX_LINE_BYTES = int(os.getenv("BULK_INVOICE_MAX_LINE_BYTES", 64 * 1024))  # longer NDJSON lines get a 413 result
+
+# Materialised /payments/get-stats
+STATS_SOURCE = os.getenv("STATS_SOURCE", "store")  # store | live
+STATS_STORE_PATH = os.getenv("STATS_STORE_PATH", "stats.db")
+STATS_BACKFILL_INTERVAL = int(os.getenv("STATS_BACKFILL_INTERVAL", 3600))  # 0 disables the job
+
+# Per-account /payments/get-stats response cache
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 5))
+STATS_CACHE_STALE_TTL = float(os.getenv("STATS_CACHE_STALE_TTL", 30))  # serve stale while refreshing for this long
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", 10000))
+
+# Stripe call gateway. Stripe allows 100 requests/s in live mode and 25/s in test mode
+STRIPE_GLOBAL_RATE = float(os.getenv("STRIPE_GLOBAL_RATE", 90))  # across all worker processes
+STRIPE_ACCOUNT_RATE = float(os.getenv("STRIPE_ACCOUNT_RATE", 25))  # across all worker processes
+STRIPE_MAX_RETRIES = int(os.getenv("STRIPE_MAX_RETRIES", 4))
+STRIPE_RETRY_BASE_DELAY = float(os.getenv("STRIPE_RETRY_BASE_DELAY", 0.5))
+STRIPE_RETRY_MAX_DELAY = float(os.getenv("STRIPE_RETRY_MAX_DELAY", 8))
+
+# Connection pool the Stripe SDK sends through, one per worker process. The rate limits
+# above cap how many calls are in flight, so a larger pool only adds connections to scan
+STRIPE_POOL_LIMIT = int(os.getenv("STRIPE_POOL_LIMIT", 30))
+STRIPE_POOL_KEEPALIVE = int(os.getenv("STRIPE_POOL_KEEPALIVE", STRIPE_POOL_LIMIT))  # idle connections kept open; fewer means new TLS handshakes after bursts
+STRIPE_KEEPALIVE_TIMEOUT = float(os.getenv("STRIPE_KEEPALIVE_TIMEOUT", 15))
+STRIPE_CONNECT_TIMEOUT = float(os.getenv("STRIPE_CONNECT_TIMEOUT", 5))
+STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", 30))
+STRIPE_HTTP2 = os.getenv("STRIPE_HTTP2", "true").lower() == "true"  # used only when the h2 package is installed
+
+# Users table behind /auth/signup's duplicate check, one asyncpg pool per worker process.
+# Unset, signups aren't checked against it
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 5))
+SIGNUP_CLAIM_TTL = float(os.getenv("SIGNUP_CLAIM_TTL", 300))  # seconds an unfinished signup holds its email
+DB_SET_ACCOUNT_ATTEMPTS = int(os.getenv("DB_SET_ACCOUNT_ATTEMPTS", 6))  # backing off from 0.1s, about 3s in all
+
+# Identity document uploads
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))  # Stripe's limit for account_requirement files
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", 64 * 1024))
+# Whole /auth/update-user bodies over this are refused before they're read: the file plus the form's other fields
+MAX_UPLOAD_REQUEST_BYTES = int(os.getenv("MAX_UPLOAD_REQUEST_BYTES", MAX_UPLOAD_BYTES + 1024 * 1024))
+
+# Production server (python server.py). 0 workers means one per CPU core; the entry point
+# exports the resolved count so each worker can take its share of the Stripe rate limits
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 4242))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 0))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", 2048))
+SERVER_KEEPALIVE_TIMEOUT = int(os.getenv("SERVER_KEEPALIVE_TIMEOUT", 5))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+# Routers this process serves e.g. 'webhooks' for a receiver-only deployment. Only the
+# enabled routers' modules are imported, and with them the Stripe SDK and schemas
+ENABLED_ROUTERS = [r.strip() for r in os.getenv("ENABLED_ROUTERS", "auth,payments,customer,products,webhooks").split(",") if r.strip()]
@@ -1,7 +1,6 @@
-import stripe
-
 # Directory Modules
 from models import CustomerObject
+from stripe_objects import get_or_create_customer
 
 # FastAPI Modules
 from fastapi import APIRouter
@@ -13,7 +12,8 @@ customer = APIRouter(prefix='/customer', tags=['customer'])
 @customer.post('/create')
 async def create_customer(customer_request: CustomerObject):
         try:
-            customer = await stripe.Customer.create_async(**customer_request.dict(exclude={'stripe_account'}), stripe_account="acct_1Q35XsQ8ogKFGPdO")
+            # Returns the existing customer when the account already has one with this email
+            customer = await get_or_create_customer("acct_1Q35XsQ8ogKFGPdO", **customer_request.dict(exclude={'stripe_account'}))
             return JSONResponse(
                 status_code=200, content={"customer": customer}
             )
@@ -0,0 +1,141 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Directory Modules
+import config
+from cache import TTLCache
+
+
+# Stripe puts the event id first in the envelope, and nested objects never use the evt_ prefix
+EVENT_ID_PATTERN = re.compile(rb'"id"\s*:\s*"(evt_[A-Za-z0-9]+)"')
+
+
+def extract_event_id(body: bytes) -> Optional[str]:
+    """
+    Pulls the event id out of the raw body without decoding the JSON
+    :param body: [bytes] - raw webhook body
+    :return: event id or None
+    """
+    match = EVENT_ID_PATTERN.search(body)
+    return match.group(1).decode() if match else None
+
+
+class SQLiteSeenStore:
+    def __init__(self, path: str, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS processed_events (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+
+    def _add(self, event_id: str) -> bool:
+        with self._lock:
+            now = time.time()
+            self._conn.execute("DELETE FROM processed_events WHERE id = ? AND seen_at < ?", (event_id, now - self.ttl))
+            cur = self._conn.execute("INSERT OR IGNORE INTO processed_events (id, seen_at) VALUES (?, ?)", (event_id, now))
+            return cur.rowcount == 1
+
+    async def add(self, event_id: str) -> bool:
+        """
+        :return: True if the id wasn't already stored
+        """
+        return await asyncio.to_thread(self._add, event_id)
+
+    def _remove(self, event_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM processed_events WHERE id = ?", (event_id,))
+
+    async def remove(self, event_id: str):
+        await asyncio.to_thread(self._remove, event_id)
+
+    def _purge(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM processed_events WHERE seen_at < ?", (time.time() - self.ttl,))
+
+    async def purge(self):
+        await asyncio.to_thread(self._purge)
+
+    async def close(self):
+        await asyncio.to_thread(self._conn.close)
+
+
+class RedisSeenStore:
+    PREFIX = "webhooks:seen:"
+
+    def __init__(self, url: str, ttl: int):
+        from redis import asyncio as aioredis
+
+        self.ttl = ttl
+        self._redis = aioredis.from_url(url)
+
+    async def add(self, event_id: str) -> bool:
+        return bool(await self._redis.set(self.PREFIX + event_id, 1, nx=True, ex=self.ttl))
+
+    async def remove(self, event_id: str):
+        await self._redis.delete(self.PREFIX + event_id)
+
+    async def purge(self):
+        pass  # keys expire on their own
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+class EventDeduplicator:
+    """
+    Remembers event ids that have been accepted. An in-process LRU/TTL cache answers
+    most lookups; the optional shared store catches replays that land on another
+    worker process or arrive after a restart.
+    """
+    def __init__(self, max_size: int, ttl: int, store=None):
+        self.cache = TTLCache(max_size, ttl)
+        self.store = store
+        self.duplicates = 0
+
+    async def is_duplicate(self, event_id: str) -> bool:
+        """
+        Checks and records the id in one step
+        :param event_id: [str]
+        :return: True if the event has been seen before
+        """
+        if self.cache.get(event_id) is not None:
+            self.duplicates += 1
+            return True
+
+        if self.store is not None and not await self.store.add(event_id):
+            self.duplicates += 1
+            return True
+        # Cached only once the store has it, so a failed add doesn't turn away the retry
+        self.cache.set(event_id, True)
+        return False
+
+    async def forget(self, event_id: str):
+        """Un-records an id whose event couldn't be accepted, so Stripe's retry goes through"""
+        self.cache.pop(event_id)
+        if self.store is not None:
+            await self.store.remove(event_id)
+
+    async def purge(self):
+        if self.store is not None:
+            await self.store.purge()
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "duplicates": self.duplicates}
+
+    async def close(self):
+        if self.store is not None:
+            await self.store.close()
+
+
+def create_deduplicator() -> EventDeduplicator:
+    store = None
+    if config.WEBHOOK_DEDUP_BACKEND == "sqlite":
+        store = SQLiteSeenStore(config.WEBHOOK_DEDUP_PATH, config.WEBHOOK_DEDUP_TTL)
+    elif config.WEBHOOK_DEDUP_BACKEND == "redis":
+        store = RedisSeenStore(config.REDIS_URL, config.WEBHOOK_DEDUP_TTL)
+    return EventDeduplicator(config.WEBHOOK_DEDUP_SIZE, config.WEBHOOK_DEDUP_TTL, store)
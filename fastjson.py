@@ -0,0 +1,25 @@
+"""
+orjson when it's installed, the standard library otherwise. Both return the same
+plain dicts and lists, so callers don't need to know which one is in use.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+else:
+    loads = json.loads
+
+    def dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
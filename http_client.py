@@ -0,0 +1,51 @@
+from typing import Optional
+
+import aiohttp
+
+# Directory Modules
+import config
+import fastjson
+from metrics import aiohttp_trace_config
+
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def open_session() -> aiohttp.ClientSession:
+    """
+    Creates the app-wide pooled session. Called once from the app lifespan
+    :return: aiohttp.ClientSession
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=config.HTTP_POOL_LIMIT,
+            limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=config.HTTP_TOTAL_TIMEOUT,
+            sock_connect=config.HTTP_CONNECT_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout, json_serialize=fastjson.dumps, trace_configs=[aiohttp_trace_config()]
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared session, opening it lazily if the lifespan
+    hook hasn't run (e.g. when the app is mounted without lifespan events)
+    :return: aiohttp.ClientSession
+    """
+    if _session is None or _session.closed:
+        return await open_session()
+    return _session
@@ -0,0 +1,153 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# Directory Modules
+import config
+
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+stripe_request_id: ContextVar[Optional[str]] = ContextVar("stripe_request_id", default=None)
+
+# Attributes every LogRecord has; anything else on a record came in through `extra=`
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName", "color_message"}
+
+_listener: Optional[QueueListener] = None
+
+
+class ContextFilter(logging.Filter):
+    """Stamps the correlation IDs onto the record in the caller's context, before it crosses the queue"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        record.stripe_request_id = stripe_request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        The stock handler formats the whole message on the calling side; only the
+        argument merge and the traceback text are needed there, JSON encoding and
+        the write to stdout happen on the listener thread
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(spec: str) -> dict:
+    """
+    :param spec: [str] - e.g. 'stripe_gateway=DEBUG,webhooks=WARNING'
+    :return: {logger name: level}
+    """
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """
+    Routes every logger through a non-blocking queue handler; a single listener thread
+    encodes the records as JSON lines and writes them to stdout. Safe to call more than once
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(config.LOG_LEVEL.upper())
+    # The SDK logs every API response at INFO, and httpx, which it sends through, every request.
+    # The gateway already covers both at DEBUG
+    quiet = {"stripe": "WARNING", "httpx": "WARNING", "httpcore": "WARNING"}
+    for name, level in {**quiet, **parse_levels(config.LOG_LEVELS)}.items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flushes whatever is still queued"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestContextMiddleware:
+    """
+    Gives each request a correlation ID, taken from X-Request-ID when the caller sends one,
+    echoes it back on the response and writes one access record per request
+    """
+    def __init__(self, app):
+        self.app = app
+        self.logger = logging.getLogger("access")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        incoming = dict(scope["headers"]).get(b"x-request-id")
+        rid = incoming.decode("latin-1") if incoming else uuid.uuid4().hex
+        token = request_id.set(rid)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", rid.encode("latin-1"))]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            if self.logger.isEnabledFor(logging.INFO):
+                route = scope.get("route")
+                self.logger.info("request", extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": getattr(route, "path", None),
+                    "status": status,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                })
+            request_id.reset(token)
@@ -0,0 +1,167 @@
+import time
+from bisect import bisect_left
+
+import aiohttp
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    Label values are passed positionally in the order of `labels`, and samples live in a
+    plain dict keyed by that tuple, so recording is a dict lookup and an add
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        REGISTRY.append(self)
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def total(self):
+        """Sum across every label combination"""
+        return sum(self._values.values())
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for label_values, value in list(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) - amount
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values):
+        entry = self._values.get(label_values)
+        if entry is None:
+            # Per-bucket (not yet cumulative) counts with +Inf last, sum, count
+            entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for label_values, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+def render() -> str:
+    """Prometheus text exposition format for every registered metric in this process"""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+HTTP_DURATION = Histogram("http_request_duration_seconds", "Time spent handling a request", ("method", "route", "status"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being handled")
+HTTP_ERRORS = Counter("http_request_errors_total", "Requests answered with a 5xx", ("method", "route", "status"))
+
+STRIPE_DURATION = Histogram("stripe_request_duration_seconds", "Latency of Stripe API calls, including retries", ("resource", "operation", "account"))
+STRIPE_IN_FLIGHT = Gauge("stripe_requests_in_flight", "Stripe API calls currently awaiting a response", ("resource",))
+STRIPE_ERRORS = Counter("stripe_request_errors_total", "Stripe API calls that raised after any retries", ("resource", "operation", "account", "error"))
+STRIPE_QUEUE_DEPTH = Gauge("stripe_gateway_queue_depth", "Stripe calls waiting for a rate-limit token")
+STRIPE_RETRIES = Counter("stripe_gateway_retries_total", "Stripe calls retried after a 429, 5xx or connection error", ("resource",))
+
+OUTBOUND_DURATION = Histogram("http_client_request_duration_seconds", "Latency of outbound aiohttp requests", ("host", "method", "status"))
+OUTBOUND_ERRORS = Counter("http_client_request_errors_total", "Outbound aiohttp requests that failed to complete", ("host", "method", "error"))
+
+WEBHOOK_REJECTED = Counter("webhook_rejected_total", "Webhook requests rejected before queueing", ("reason",))
+WEBHOOK_EVENTS = Counter("webhook_events_total", "Webhook events by type and outcome (received, ignored, processed, failed)", ("type", "outcome"))
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, so it adds no task or body buffering to the request path"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # The router records the matched route on the scope; use its template to keep cardinality down
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            HTTP_DURATION.observe(time.perf_counter() - start, scope["method"], path, status)
+            if status >= 500:
+                HTTP_ERRORS.inc(scope["method"], path, status)
+
+
+def aiohttp_trace_config() -> aiohttp.TraceConfig:
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        OUTBOUND_DURATION.observe(time.perf_counter() - context.start, params.url.host, params.method, params.response.status)
+
+    async def on_request_exception(session, context, params):
+        OUTBOUND_ERRORS.inc(params.url.host, params.method, type(params.exception).__name__)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
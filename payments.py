@@ -1,20 +1,117 @@
+import asyncio
 import json
-import sys
+import logging
+import os
+import socket
+import time
 import stripe
-import httpx
 from datetime import datetime
 
 # Directory
+import config
+import stripe_gateway
+from cache import price_cache, stats_cache
 from models import InvoiceObject, InvoiceDeleteObject, UpdateInvoiceObject, StatRequestObject
+from rate_limit import TokenBucket
+from stats_store import stats_store, day_of
+from stripe_objects import get_or_create_customer, get_or_create_product
 from tools import deep_convert_to_dict
 # FastAPI
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
 
 
 # Init
 payments = APIRouter(prefix='/payments', tags=['payments'])
 
+bulk_invoice_limiter = TokenBucket(config.BULK_INVOICE_RATE)
+
+logger = logging.getLogger(__name__)
+
+
+async def get_price_id(product_id: str, connect_account_id: str) -> str:
+    """
+    :param product_id: [str]
+    :param connect_account_id: [str]
+    :return: ID of the first price listed for the product
+    """
+    price_id = price_cache.get((connect_account_id, product_id))
+    if price_id is None:
+        prices = await stripe_gateway.call(stripe.Price.list_async, product=product_id, stripe_account=connect_account_id)
+        price_id = prices['data'][0]['id']
+        price_cache.set((connect_account_id, product_id), price_id)
+    return price_id
+
+
+async def create_product_and_price(data: dict, connect_account_id: str):
+    """
+    :param data: [dict] - invoice data containing 'new_product', 'unit_amount' and 'currency'
+    :param connect_account_id: [str]
+    :return: Price object
+    """
+    # Reuses the account's product of the same name, if it has one
+    product = await get_or_create_product(connect_account_id,
+        name=data.get("new_product", {}).get("name"),
+        description=data.get("new_product", {}).get("description"),
+        active=data.get("new_product", {}).get("active"),
+    )
+
+    return await stripe_gateway.call(stripe.Price.create_async,
+        product=product['id'],
+        unit_amount=data.get('unit_amount'),
+        currency=data.get('currency'),
+        stripe_account=connect_account_id
+    )
+
+
+async def create_customer_and_invoice(data: dict, connect_account_id: str, days_until_due, **invoice_kwargs):
+    """
+    :param data: [dict] - invoice data containing 'new_customer' and 'unit_amount'
+    :param connect_account_id: [str]
+    :param days_until_due: [int]
+    :return: (customer, Invoice object)
+    """
+    # Repeat buyers are matched by email rather than getting a new Customer each time
+    customer = await get_or_create_customer(connect_account_id,
+        name=data.get("new_customer", {}).get("name"),
+        email=data.get("new_customer", {}).get("email"),
+        description=data.get("new_customer", {}).get("description", None),
+    )
+
+    invoice = await stripe_gateway.call(stripe.Invoice.create_async,
+        customer=customer['id'],
+        collection_method='send_invoice',
+        stripe_account=connect_account_id,
+        application_fee_amount=int(data.get("unit_amount", 0) * 0.02),
+        days_until_due=days_until_due,
+        **invoice_kwargs
+    )
+    return customer, invoice
+
+
+async def create_invoice_for_customer(data: dict, customer_id: str, connect_account_id: str, days_until_due, **invoice_kwargs):
+    """
+    :param data: [dict] - invoice data containing 'unit_amount'
+    :param customer_id: [str]
+    :param connect_account_id: [str]
+    :param days_until_due: [int]
+    :return: Invoice object
+    """
+    return await stripe_gateway.call(stripe.Invoice.create_async,
+        customer=customer_id,
+        collection_method='send_invoice',
+        stripe_account=connect_account_id,
+        application_fee_amount=int(data.get("unit_amount", 0) * 0.02),
+        days_until_due=days_until_due,
+        **invoice_kwargs
+    )
+
+
+# The builders below run every Stripe call that doesn't depend on another one concurrently.
+# The only hard dependencies are Product -> Price, Customer -> Invoice and
+# (Price, Invoice) -> InvoiceItem, so each one is at most three round-trips deep.
+
 
 async def create_invoice_with_new_product_and_customer(og_data, days_until_due=None):
     """
@@ -26,42 +123,15 @@ async def create_invoice_with_new_product_and_customer(og_data, days_until_due=N
     data = deep_convert_to_dict(data)
     connect_account_id = data.get("issuer", {}).get("account")
 
-
     try:
-        product = await stripe.Product.create_async(
-            name=data.get("new_product", {}).get("name"),
-            description=data.get("new_product", {}).get("description"),
-            active=data.get("new_product", {}).get("active"),
-            stripe_account=connect_account_id
-        )
-
-        price = await stripe.Price.create_async(
-            product=product['id'],
-            unit_amount=data.get('unit_amount'),
-            currency=data.get('currency'),
-            stripe_account=connect_account_id
-        )
-
-        customer = await stripe.Customer.create_async(
-            name=data.get("new_customer", {}).get("name"),
-            email=data.get("new_customer", {}).get("email"),
-            description=data.get("new_customer", {}).get("description", None),
-            stripe_account=connect_account_id
-        )
-
-        invoice = await stripe.Invoice.create_async(
-            auto_advance=True, #  data['auto_advance'],
-            customer=customer['id'],
-            collection_method='send_invoice',
-            stripe_account=connect_account_id,
-            application_fee_amount=int(data.get("unit_amount", 0) * 0.02),
-            days_until_due=days_until_due,
+        price, (customer, invoice) = await asyncio.gather(
+            create_product_and_price(data, connect_account_id),
+            create_customer_and_invoice(data, connect_account_id, days_until_due, auto_advance=True)  # data['auto_advance']
         )
-        return await stripe.InvoiceItem.create_async(customer=customer['id'], price=price['id'], invoice=invoice['id'], stripe_account=connect_account_id)
+        return await stripe_gateway.call(stripe.InvoiceItem.create_async, customer=customer['id'], price=price['id'], invoice=invoice['id'], stripe_account=connect_account_id)
     
     except Exception as e:
-        print(f"Line {sys.exc_info()[-1].tb_lineno}| [{create_invoice_with_new_product_and_customer.__name__}] - {e}")
-        raise Exception(f"Line {sys.exc_info()[-1].tb_lineno}| [{create_invoice_with_new_product_and_customer.__name__}] - {e}")
+        raise Exception(f"[{create_invoice_with_new_product_and_customer.__name__}] - {e}") from e
 
 
 async def create_invoice_with_existing_customer(og_data, days_until_due):
@@ -73,34 +143,19 @@ async def create_invoice_with_existing_customer(og_data, days_until_due):
     :return: InvoiceItem object
     """
     data = {k: v for k, v in og_data.items() if v is not None}
+    data = deep_convert_to_dict(data)
     connect_account_id = data.get("issuer", {}).get("account")
 
     try:
-        product = await stripe.Product.create_async(
-            name=data.get("new_product", {}).get("name"),
-            active=data.get("new_product", {}).get("active"),
-            stripe_account=connect_account_id
-        )
-
-        price = await stripe.Price.create_async(
-            product=product['id'],
-            unit_amount=data.get('unit_amount'),
-            currency=data.get('currency'),
-            stripe_account=connect_account_id
-        )
-
-        invoice = await stripe.Invoice.create_async(
-            auto_advance=data.get('auto_advance', True),
-            customer=data.get("customer_id"),
-            collection_method='send_invoice',
-            stripe_account=connect_account_id,
-            application_fee_amount=int(data.get("unit_amount", 0) * 0.02),
-            days_until_due=days_until_due,
+        price, invoice = await asyncio.gather(
+            create_product_and_price(data, connect_account_id),
+            create_invoice_for_customer(data, data.get("customer_id"), connect_account_id, days_until_due,
+                                        auto_advance=data.get('auto_advance', True))
         )
-        return await stripe.InvoiceItem.create_async(customer=data.get('customer_id'), price=price['id'], invoice=invoice['id'],
+        return await stripe_gateway.call(stripe.InvoiceItem.create_async, customer=data.get('customer_id'), price=price['id'], invoice=invoice['id'],
                                      stripe_account=connect_account_id)
     except Exception as e:
-        raise Exception(f"Line {sys.exc_info()[-1].tb_lineno}| [{create_invoice_with_existing_customer.__name__}] - {e}")
+        raise Exception(f"[{create_invoice_with_existing_customer.__name__}] - {e}") from e
 
 
 async def create_invoice_with_product_id(og_data, days_until_due):
@@ -112,32 +167,18 @@ async def create_invoice_with_product_id(og_data, days_until_due):
     :return: InvoiceItem object
     """
     data = {k: v for k, v in og_data.items() if v is not None}
+    data = deep_convert_to_dict(data)
     connect_account_id = data.get("issuer", {}).get("account")
 
     try:
-        price = await stripe.Price.list_async(
-            product=data["product_id"],
-            stripe_account=connect_account_id
-        ).get('data', [])[0].get('id')
-
-        customer = await stripe.Customer.create_async(
-            name=data.get("new_customer", {}).get("name"),
-            email=data.get("new_customer", {}).get("email"),
-            description=data.get("new_customer", {}).get("description", None),
-            stripe_account=connect_account_id
-        )
-
-        invoice = await stripe.Invoice.create_async(
-            customer=customer['id'],
-            collection_method='send_invoice',
-            stripe_account=connect_account_id,
-            application_fee_amount=int(data.get("unit_amount", 0) * 0.02),
-            days_until_due=days_until_due,
+        price, (customer, invoice) = await asyncio.gather(
+            get_price_id(data["product_id"], connect_account_id),
+            create_customer_and_invoice(data, connect_account_id, days_until_due)
         )
-        return await stripe.InvoiceItem.create_async(customer=customer['id'], price=price, invoice=invoice['id'],
+        return await stripe_gateway.call(stripe.InvoiceItem.create_async, customer=customer['id'], price=price, invoice=invoice['id'],
                                          stripe_account=connect_account_id)
     except Exception as e:
-        raise Exception(f"Line {sys.exc_info()[-1].tb_lineno}| [{create_invoice_with_product_id.__name__}] - {e}")
+        raise Exception(f"[{create_invoice_with_product_id.__name__}] - {e}") from e
 
 
 async def create_invoice_with_premade_entities(og_data, days_until_due):
@@ -152,23 +193,59 @@ async def create_invoice_with_premade_entities(og_data, days_until_due):
     connect_account_id = data.get("issuer", {}).get("account")
 
     try:
-        price = await stripe.Price.list_async(
-            product="prod_Qv6PIuYELoWeK6",
-            stripe_account="acct_1Q35XsQ8ogKFGPdO"
-        ).get('data', [])[0].get('id')
-
-        invoice = await stripe.Invoice.create_async(
-            customer=data['customer_id'],
-            collection_method='send_invoice',
-            stripe_account=connect_account_id,
-            application_fee_amount=int(data.get("unit_amount", 0) * 0.02),
-            days_until_due=days_until_due
+        price, invoice = await asyncio.gather(
+            get_price_id(data['product_id'], connect_account_id),
+            create_invoice_for_customer(data, data['customer_id'], connect_account_id, days_until_due)
         )
-        return await stripe.InvoiceItem.create_async(customer=data['customer_id'], price=price, invoice=invoice['id'],
+        return await stripe_gateway.call(stripe.InvoiceItem.create_async, customer=data['customer_id'], price=price, invoice=invoice['id'],
                                          stripe_account=connect_account_id)
     except Exception as e:
-        raise Exception(f"Line {sys.exc_info()[-1].tb_lineno}| [{create_invoice_with_premade_entities.__name__}] - {e}")
+        raise Exception(f"[{create_invoice_with_premade_entities.__name__}] - {e}") from e
+
+
 
+async def issue_invoice(invoice_request: InvoiceObject) -> dict:
+    """
+    Picks the builder for the entities supplied, then finalises unless a draft was asked for
+    :param invoice_request:
+    :return: response content
+    """
+    # Calculating the days until due
+    invoice_request_due_date = datetime.strptime(invoice_request.due_date, "%Y-%m-%d")
+    date = datetime.now()
+    until_due = (invoice_request_due_date - date).days
+    days_until_due = int(until_due)
+
+    invoice_request_obj = invoice_request.__dict__
+    invoice_request_obj['issuer'] = {'type': 'account'}
+    # invoice_request_obj['issuer']['account'] = 'acct_1Q35XsQ8ogKFGPdO'
+    invoice_request_obj['issuer']['account'] = invoice_request.stripe_account
+
+    # Creating the invoice
+    if invoice_request.customer_id and not invoice_request.product_id:
+        invoice = await create_invoice_with_existing_customer(invoice_request.__dict__, days_until_due)
+    elif invoice_request.product_id and not invoice_request.customer_id:
+        invoice = await create_invoice_with_product_id(invoice_request.__dict__, days_until_due)
+    elif invoice_request.product_id and invoice_request.customer_id:
+        invoice = await create_invoice_with_premade_entities(invoice_request.__dict__, days_until_due)
+    else:
+        invoice = await create_invoice_with_new_product_and_customer(og_data=invoice_request.__dict__, days_until_due=days_until_due)
+
+    status = 'draft'
+    # Finalising
+    if invoice_request.draft == False:
+        logger.debug("Finalizing invoice", extra={"invoice": invoice.invoice})
+        await stripe_gateway.call(stripe.Invoice.finalize_invoice_async, invoice.invoice, stripe_account=invoice_request.stripe_account)
+        status = 'open'
+
+    return {
+        "message": "Successfully created invoice",
+        'invoice': {
+            "invoice": invoice['invoice'],
+            "amount": invoice['amount'],
+        },
+        "status": status
+    }
 
 
 @payments.post("/invoice/create")
@@ -180,48 +257,163 @@ async def create_invoice(invoice_request: InvoiceObject):
     -   500, Server Error
     """
     try:
-        # Calculating the days until due
-        invoice_request_due_date = datetime.strptime(invoice_request.due_date, "%Y-%m-%d")
-        date = datetime.now()
-        until_due = (invoice_request_due_date - date).days
-        days_until_due = int(until_due)
-
-        invoice_request_obj = invoice_request.__dict__
-        invoice_request_obj['issuer'] = {'type': 'account'}
-        # invoice_request_obj['issuer']['account'] = 'acct_1Q35XsQ8ogKFGPdO'
-        invoice_request_obj['issuer']['account'] = invoice_request.stripe_account
-
-        async with httpx.AsyncClient() as client:
-            # Creating the invoice
-            if invoice_request.customer_id and not invoice_request.product_id:
-                invoice = await create_invoice_with_existing_customer(invoice_request.__dict__, days_until_due)
-            elif invoice_request.product_id and not invoice_request.customer_id:
-                invoice = await create_invoice_with_product_id(invoice_request.__dict__, days_until_due)
-            elif invoice_request.product_id and invoice_request.customer_id:
-                invoice = await create_invoice_with_premade_entities(invoice_request.__dict__, days_until_due)
-            else:
-                invoice = await create_invoice_with_new_product_and_customer(og_data=invoice_request.__dict__, days_until_due=days_until_due)
-
-            status = 'draft'
-            # Finalising
-            if invoice_request.draft == False:
-                print("Finalizing invoice")
-                await stripe.Invoice.finalize_invoice_async(invoice.invoice, stripe_account=invoice_request.stripe_account)
-                status = 'open'
-
-        return JSONResponse(status_code=200, content={
-            "message": "Successfully created invoice",
-            'invoice': {
-                "invoice": invoice['invoice'],
-                "amount": invoice['amount'],
-            },
-            "status": status
-        })
+        content = await issue_invoice(invoice_request)
+        return JSONResponse(status_code=200, content=content)
     except Exception as e:
-        print(e)
+        logger.exception("Invoice creation failed", extra={"account": invoice_request.stripe_account})
         return JSONResponse(status_code=500, content={"message": "Something went wrong", 'type': f"Type: {type(e)}", 'detail': str(e)})
 
 
+class BulkResultsResponse(StreamingResponse):
+    """
+    The results stream out while an NDJSON request body is still being read, and reading it
+    is what notices a disconnect until then. So unlike StreamingResponse this only starts
+    consuming `receive` itself once `body_read` is set. Either way a disconnect cancels the
+    stream, and with it every invoice still in flight.
+    """
+    def __init__(self, content, body_read: asyncio.Event, **kwargs):
+        super().__init__(content, **kwargs)
+        self.body_read = body_read
+
+    async def __call__(self, scope, receive, send):
+        async def watch():
+            await self.body_read.wait()
+            await self.listen_for_disconnect(receive)
+
+        streaming = asyncio.create_task(self.stream_response(send))
+        watching = asyncio.create_task(watch())
+        try:
+            await asyncio.wait((streaming, watching), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (streaming, watching):
+                task.cancel()
+            await asyncio.gather(streaming, watching, return_exceptions=True)
+        error = None if streaming.cancelled() else streaming.exception()
+        if error is not None and not isinstance(error, ClientDisconnect):
+            raise error
+
+
+LINE_TOO_LONG = object()
+
+
+async def read_ndjson(request: Request, body_read: asyncio.Event):
+    """
+    :param request:
+    :param body_read: [asyncio.Event] - set once the whole body has arrived
+    :return: (index, raw line) for each non-empty line, as the body arrives, or
+        (index, LINE_TOO_LONG) for one over BULK_INVOICE_MAX_LINE_BYTES
+    """
+    index, buffer, more_body, skipping = 0, b"", True, False
+    while more_body:
+        # Read off `receive` rather than request.stream() to know as soon as the last chunk is in
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnect()
+        more_body = message.get("more_body", False)
+        if not more_body:
+            body_read.set()
+        buffer += message.get("body", b"")
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if skipping:
+                # The rest of a line already reported as too long
+                skipping = False
+            elif len(line) > config.BULK_INVOICE_MAX_LINE_BYTES:
+                yield index, LINE_TOO_LONG
+                index += 1
+            elif line.strip():
+                yield index, line
+                index += 1
+        # A line is never buffered past the limit; it's reported once and the rest of it dropped
+        if len(buffer) > config.BULK_INVOICE_MAX_LINE_BYTES:
+            if not skipping:
+                yield index, LINE_TOO_LONG
+                index += 1
+            skipping, buffer = True, b""
+    if buffer.strip() and not skipping:
+        yield index, buffer
+
+
+async def read_json_list(items: list):
+    for index, item in enumerate(items):
+        yield index, item
+
+
+async def issue_bulk_item(index: int, raw) -> dict:
+    if raw is LINE_TOO_LONG:
+        return {"index": index, "status_code": 413, "detail": f"Line longer than {config.BULK_INVOICE_MAX_LINE_BYTES} bytes"}
+    try:
+        payload = json.loads(raw) if isinstance(raw, bytes) else raw
+        invoice_request = InvoiceObject(**payload)
+    except (ValueError, TypeError) as e:
+        return {"index": index, "status_code": 422, "detail": str(e)}
+
+    await bulk_invoice_limiter.acquire()
+    try:
+        return {"index": index, "status_code": 200, **await issue_invoice(invoice_request)}
+    except Exception as e:
+        logger.exception("Bulk invoice item failed", extra={"index": index, "account": invoice_request.stripe_account})
+        return {"index": index, "status_code": 500, "message": "Something went wrong", 'type': f"Type: {type(e)}", 'detail': str(e)}
+
+
+async def stream_bulk_results(items, concurrency: int):
+    """
+    Keeps at most `concurrency` invoices in flight, only pulling the next item off `items`
+    once a slot frees up, and yields each result as an NDJSON line as soon as it completes
+    :param items: async iterator of (index, payload)
+    :param concurrency: [int]
+    """
+    in_flight = set()
+    try:
+        async for index, raw in items:
+            if len(in_flight) >= concurrency:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield json.dumps(task.result()) + "\n"
+            in_flight.add(asyncio.create_task(issue_bulk_item(index, raw)))
+
+        while in_flight:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield json.dumps(task.result()) + "\n"
+    finally:
+        # Reached early when the client has gone, so nothing still running has anyone to report to
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+@payments.post("/invoice/bulk")
+async def create_invoices_bulk(request: Request):
+    """
+    Accepts either a JSON array of InvoiceObject payloads or an application/x-ndjson body
+    with one per line. Results are streamed back as NDJSON in completion order, each
+    carrying the `index` of the item it belongs to.
+    :param request:
+    :return:
+    -   200, NDJSON stream of per-item results
+    -   422, Body isn't a JSON array
+    """
+    body_read = asyncio.Event()
+    if "ndjson" in request.headers.get("content-type", ""):
+        items = read_ndjson(request, body_read)
+    else:
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = None
+        if not isinstance(payload, list):
+            return JSONResponse(status_code=422, content={"message": "Expected a JSON array of invoices"})
+        items = read_json_list(payload)
+        body_read.set()
+
+    return BulkResultsResponse(
+        stream_bulk_results(items, config.BULK_INVOICE_CONCURRENCY),
+        body_read=body_read,
+        media_type="application/x-ndjson"
+    )
+
+
 @payments.put("/invoice/update")
 async def update_invoice(update_invoice_request: UpdateInvoiceObject):
     try:
@@ -234,7 +426,7 @@ async def update_invoice(update_invoice_request: UpdateInvoiceObject):
             "customer_name", "lines", "paid_out_of_band", "account_name", "starting_balance", "application",
             'paid'
         ]
-        current_invoice_item = await stripe.InvoiceItem.list_async(
+        current_invoice_item = await stripe_gateway.call(stripe.InvoiceItem.list_async,
             invoice=update_invoice_request.id,
             stripe_account=update_invoice_request.stripe_account
         )
@@ -249,72 +441,187 @@ async def update_invoice(update_invoice_request: UpdateInvoiceObject):
 async def delete_invoice(delete_invoice_request: InvoiceDeleteObject):
     try:
         # Can only delete draft invoices
-        stripe.Invoice.delete(delete_invoice_request.invoice_id, stripe_account=delete_invoice_request.connected_account_id)
+        await stripe_gateway.call(stripe.Invoice.delete_async, delete_invoice_request.invoice_id, stripe_account=delete_invoice_request.connected_account_id)
     except Exception as e:
-        print(e)
+        logger.exception("Invoice deletion failed", extra={"invoice": delete_invoice_request.invoice_id})
         return JSONResponse(status_code=500, content={"message": "Something went wrong"})
 
 
 
-@payments.post("/get-stats")
-async def get_stats(stats_request: StatRequestObject):
+async def timed(name: str, timings: dict, coro):
+    """Awaits `coro`, recording how long it took in milliseconds under timings[name]"""
+    start = time.perf_counter()
     try:
-        today_midnight = int(datetime(datetime.now().year, datetime.now().month, datetime.now().day, 0, 0).timestamp())
-        yesterday_midnight = today_midnight - 86400
+        return await coro
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 2)
 
-        func_args = {**stats_request.dict(), "created": {}}
-        balance = await stripe.Balance.retrieve_async(**stats_request.dict())
-        balance = balance['available'][0]['amount']
 
-        # Sales
-        func_args['created']['gt'] = today_midnight
-        todays_data = await stripe.PaymentIntent.list_async(**func_args)
-        todays_sales = sum(item['amount_received'] for item in todays_data['data']) / 100
-        try: todays_average_order_value = todays_sales / len(todays_data['data'])
-        except ZeroDivisionError: todays_average_order_value = 0
+async def count_and_sum(resource, field: str = None, where=None, on_page=None, **params):
+    """
+    Walks every page of a Stripe list, keeping only a running count and total
+    :param resource: Stripe resource class with list_async, e.g. stripe.PaymentIntent
+    :param field: [str] - numeric field to sum, if any
+    :param where: [Callable] - only count items this returns True for
+    :param on_page: [Callable] - coroutine given each page's counted items before the next page is fetched
+    :return: (count, total)
+    """
+    page = await stripe_gateway.call(resource.list_async, limit=100, **params)
+    count, total = 0, 0
+    while True:
+        kept = [item for item in page if where is None or where(item)]
+        count += len(kept)
+        if field is not None:
+            total += sum(item.get(field) or 0 for item in kept)
+        if on_page is not None and kept:
+            await on_page(kept)
+        if not page.get("has_more"):
+            return count, total
+        # Paging by hand rather than with auto_paging_iter so each page goes through the gateway
+        page = await stripe_gateway.call(page.next_page_async, stripe_account=params.get("stripe_account"))
+
+
+async def count_transactions(**params) -> int:
+    try:
+        count, _ = await count_and_sum(stripe.issuing.Transaction, **params)
+        return count
+    except Exception as e:
+        # Issuing isn't enabled on every account
+        logger.info("Skipping issuing transactions", extra={"account": params.get("stripe_account"), "error": str(e)})
+        return 0
 
-        func_args["created"]["gt"] = yesterday_midnight
-        func_args['created']['lt'] = today_midnight
-        yesterday_data = await stripe.PaymentIntent.list_async(**func_args)
-        yesterday_sales = sum(item['amount_received'] for item in todays_data['data'])
-        try: yesterday_average_order_value = todays_sales / len(yesterday_data['data'])
-        except ZeroDivisionError: yesterday_average_order_value = 0
 
-        avg_order_value_growth = todays_average_order_value - yesterday_average_order_value
+def stat_days():
+    """
+    :return: (today, yesterday) as YYYY-MM-DD, and the created filters for each
+    """
+    now = datetime.now()
+    today_midnight = int(datetime(now.year, now.month, now.day, 0, 0).timestamp())
+    yesterday_midnight = today_midnight - 86400
+    return (
+        (day_of(today_midnight), {"gte": today_midnight}),
+        (day_of(yesterday_midnight), {"gte": yesterday_midnight, "lt": today_midnight}),
+    )
 
-        try:
-            sales_growth = todays_sales - yesterday_sales / yesterday_sales * 100
-        except ZeroDivisionError:
-            sales_growth = 0
 
-        # Customers
-        yesterday_customers = await stripe.Customer.list_async(**func_args)
-        yesterday_customers_count = len(yesterday_customers['data'])
+async def fetch_day(stripe_account: str, created: dict, timings: dict, label: str, day: str = None) -> dict:
+    """
+    :param day: [str] - YYYY-MM-DD to add each page's objects to the stats_store ledger under, if any
+    :return: a stats_store row for the given created range, built from Stripe lists
+    """
+    def ledger(to_deltas):
+        if day is None:
+            return None
+        return lambda items: stats_store.add_objects(stripe_account, day, {item["id"]: to_deltas(item) for item in items})
+
+    (orders, sales), (new_customers, _), transactions = await asyncio.gather(
+        timed(f"{label}_sales", timings, count_and_sum(
+            stripe.PaymentIntent, "amount_received", where=lambda pi: pi.get("status") == "succeeded",
+            on_page=ledger(lambda pi: {"sales": pi.get("amount_received") or 0, "orders": 1}),
+            created=created, stripe_account=stripe_account)),
+        timed(f"{label}_customers", timings, count_and_sum(
+            stripe.Customer, on_page=ledger(lambda _: {"new_customers": 1}), created=created, stripe_account=stripe_account)),
+        timed(f"{label}_transactions", timings, count_transactions(
+            on_page=ledger(lambda _: {"transactions": 1}), created=created, stripe_account=stripe_account)),
+    )
+    return {"sales": sales, "orders": orders, "new_customers": new_customers, "transactions": transactions}
+
+
+async def fetch_stats(stripe_account: str, record: bool):
+    """
+    Counts today's and yesterday's objects and the balance from Stripe, fanning the independent
+    queries out concurrently
+    :param stripe_account: [str]
+    :param record: [bool] - also add the objects to the ledger a page at a time, then mark the account reconciled
+    :return: (balance, {day: row}, per-query timings in ms)
+    """
+    (today, today_created), (yesterday, yesterday_created) = stat_days()
+    timings = {}
+    balance, today_row, yesterday_row = await asyncio.gather(
+        timed("balance", timings, stripe_gateway.call(stripe.Balance.retrieve_async, stripe_account=stripe_account)),
+        fetch_day(stripe_account, today_created, timings, "todays", today if record else None),
+        fetch_day(stripe_account, yesterday_created, timings, "yesterdays", yesterday if record else None),
+    )
+    balance = balance['available'][0]['amount']
+    if not record:
+        return balance, {today: today_row, yesterday: yesterday_row}, timings
+
+    await stats_store.finish_reconcile(stripe_account, balance, today, yesterday)
+    # Read back rather than the counts, so they include webhooks counted meanwhile
+    _, rows = await stats_store.get(stripe_account, today, yesterday)
+    return balance, rows, timings
+
+
+async def run_stats_backfill(interval: int):
+    """Periodically reconciles every account the store knows about, correcting any missed webhooks"""
+    holder = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        await asyncio.sleep(interval)
+        # Every worker process runs this loop; only the lease holder does the work
+        if not await stats_store.try_lease("stats_backfill", holder, interval * 1.5):
+            continue
+        for stripe_account in await stats_store.accounts():
+            try:
+                await fetch_stats(stripe_account, record=True)
+            except Exception as e:
+                logger.exception("Stats backfill failed", extra={"account": stripe_account})
+
+
+def summarise_stats(balance: int, today: dict, yesterday: dict) -> dict:
+    """
+    :param balance: [int] - available balance
+    :param today: [dict] - stats_store row
+    :param yesterday: [dict] - stats_store row
+    :return: get-stats response content
+    """
+    todays_sales = today["sales"] / 100
+    yesterday_sales = yesterday["sales"] / 100
+    todays_average_order_value = todays_sales / today["orders"] if today["orders"] else 0
+    yesterday_average_order_value = yesterday_sales / yesterday["orders"] if yesterday["orders"] else 0
+
+    return {
+        "balance": balance,
+        "todays_sales": todays_sales,
+        "sales_growth": (todays_sales - yesterday_sales) / yesterday_sales * 100 if yesterday_sales else 0,
+        "todays_customers": today["new_customers"],
+        "customer_growth": today["new_customers"] - yesterday["new_customers"],
+        "transaction_count": today["transactions"],
+        "todays_avg_order_value": todays_average_order_value,
+        "avg_order_value_growth": todays_average_order_value - yesterday_average_order_value
+    }
+
+
+async def compute_stats(stripe_account: str):
+    """
+    Reads the materialised rows when STATS_SOURCE is 'store' and the account has been
+    reconciled before, otherwise goes to Stripe (which in store mode also seeds the store)
+    :param stripe_account: [str]
+    :return: (stats, per-query timings in ms)
+    """
+    (today, _), (yesterday, _) = stat_days()
+    timings = {}
+
+    stored = None
+    if config.STATS_SOURCE == "store":
+        stored = await timed("store", timings, stats_store.get(stripe_account, today, yesterday))
 
-        del func_args['created']['lt']
-        func_args['created']['gt'] = today_midnight
-        today_customers = await stripe.Customer.list_async(**func_args)
-        today_customers_count = len(today_customers['data'])
-        customer_growth = today_customers_count - yesterday_customers_count
+    if stored is not None:
+        balance, rows = stored
+    else:
+        # In store mode this seeds the account; live mode only counts, writing nothing
+        balance, rows, timings = await fetch_stats(stripe_account, record=config.STATS_SOURCE == "store")
+    return summarise_stats(balance, rows[today], rows[yesterday]), timings
 
-        # Transactions
-        try:
-            todays_transactions = await stripe.issuing.Transaction.list(**func_args)
-            transaction_count = len(todays_transactions['data'])
-        except Exception as e:
-            print(f"{type(e)} - {str(e)}")
-            transaction_count = 0
-
-        content = {
-            "balance": balance,
-            "todays_sales": todays_sales,
-            "sales_growth": sales_growth,
-            "todays_customers": today_customers_count,
-            "customer_growth": customer_growth,
-            "transaction_count": transaction_count,
-            "todays_avg_order_value": todays_average_order_value,
-            "avg_order_value_growth": avg_order_value_growth
-        }
+
+@payments.post("/get-stats")
+async def get_stats(stats_request: StatRequestObject):
+    try:
+        content, timings = await stats_cache.get(
+            stats_request.stripe_account, lambda: compute_stats(stats_request.stripe_account)
+        )
+        content = dict(content)
+        if stats_request.debug:
+            content["debug"] = {"timings_ms": timings, "cache": stats_cache.stats()}
         return JSONResponse(status_code=200, content=content)
     except Exception as e:
         return JSONResponse(
@@ -1,7 +1,10 @@
 import stripe
 
 # Directory Module
+import stripe_gateway
+from cache import price_cache
 from models import CreateProductObject
+from stripe_objects import get_or_create_product
 
 # FastAPI
 from fastapi import APIRouter
@@ -15,16 +18,18 @@ async def create_product(product_request: CreateProductObject):
     try:
         product_request.stripe_account = "acct_1Q35XsQ8ogKFGPdO"
 
-        product = await stripe.Product.create_async(
-            **product_request.dict(exclude={'csrfmiddlewaretoken', 'unit_amount', 'currency'}),
+        # Prices are added to the account's product of the same name rather than a duplicate
+        product = await get_or_create_product(product_request.stripe_account,
+            **product_request.dict(exclude={'csrfmiddlewaretoken', 'unit_amount', 'currency', 'stripe_account'}),
         )
 
-        price = await stripe.Price.create_async(
+        price = await stripe_gateway.call(stripe.Price.create_async,
             product=product['id'],
             unit_amount=product_request.unit_amount,
             currency=product_request.currency,
             stripe_account=product_request.stripe_account
         )
+        price_cache.set((product_request.stripe_account, product['id']), price['id'])
 
         return JSONResponse(
             status_code=200, content={"product": {
@@ -0,0 +1,64 @@
+"""
+Production entry point.
+
+    python server.py                      # one worker per CPU core
+    python server.py --workers 4 --port 8080
+    python server.py --reload             # single process with the reloader, for development
+
+Each worker is a separate process with its own event loop; uvicorn uses uvloop and
+httptools when they're installed. The app's lifespan runs once per worker, opening
+that worker's HTTP pool, queue consumers and stores and closing them on shutdown.
+
+This module deliberately imports nothing from the app: workers are spawned, and each
+one re-imports the entry module, so anything imported here would be set up again in
+every worker.
+"""
+import argparse
+import importlib.util
+import os
+
+import uvicorn
+
+# Directory Modules
+import config
+
+
+def has_module(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=config.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=config.SERVER_WORKERS, help="0 for one per CPU core")
+    parser.add_argument("--reload", action="store_true", help="Single process that restarts on code changes")
+    args = parser.parse_args()
+
+    workers = 1 if args.reload else (args.workers or os.cpu_count() or 1)
+    # Read by config in each worker, so the Stripe rate limits are split between them
+    os.environ["SERVER_WORKERS"] = str(workers)
+    if workers > 1 and config.WEBHOOK_DEDUP_BACKEND == "memory":
+        # Stripe's retries can land on any worker, so the seen-event set has to be shared
+        os.environ["WEBHOOK_DEDUP_BACKEND"] = "sqlite"
+
+    uvicorn.run(
+        "app:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        reload=args.reload,
+        loop="uvloop" if has_module("uvloop") else "asyncio",
+        http="httptools" if has_module("httptools") else "h11",
+        lifespan="on",
+        backlog=config.SERVER_BACKLOG,
+        timeout_keep_alive=config.SERVER_KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=config.SERVER_GRACEFUL_TIMEOUT,
+        # The app writes its own structured access records; uvicorn's loggers propagate to the same handler
+        access_log=False,
+        log_config=None,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+# Directory Modules
+import config
+
+
+FIELDS = ("sales", "orders", "new_customers", "transactions")
+
+
+def day_of(timestamp: int) -> str:
+    """Local calendar day a Stripe `created` timestamp falls on, matching get_stats' midnights"""
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+class StatsStore:
+    """
+    Running daily aggregates per connected account, kept current by webhooks so
+    /payments/get-stats can answer from two primary-key lookups.
+        sales - sum of amount_received in the smallest currency unit
+        orders - succeeded PaymentIntents
+        new_customers - customers created
+        transactions - issuing transactions created
+
+    Every object counted is kept in a ledger keyed by its Stripe id, so a redelivered
+    webhook isn't counted twice, and reconciling from Stripe only adds the objects the
+    webhooks missed rather than overwriting increments that landed in the meantime.
+    An account's rows are only served once a reconciliation has completed for it.
+    """
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                account TEXT NOT NULL,
+                day TEXT NOT NULL,
+                sales INTEGER NOT NULL DEFAULT 0,
+                orders INTEGER NOT NULL DEFAULT 0,
+                new_customers INTEGER NOT NULL DEFAULT 0,
+                transactions INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (account, day)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS stats_objects (
+                account TEXT NOT NULL,
+                object_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                sales INTEGER NOT NULL DEFAULT 0,
+                orders INTEGER NOT NULL DEFAULT 0,
+                new_customers INTEGER NOT NULL DEFAULT 0,
+                transactions INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (account, object_id)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS stats_objects_day ON stats_objects (account, day)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS balances (
+                account TEXT PRIMARY KEY,
+                available INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS reconciled (
+                account TEXT PRIMARY KEY,
+                reconciled_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+    async def _run(self, func, *args):
+        def locked():
+            with self._lock:
+                return func(*args)
+        return await asyncio.to_thread(locked)
+
+    def _transaction(self, func, *args):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(*args)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def _increment(self, account: str, day: str, deltas: dict):
+        cols = [key for key in FIELDS if key in deltas]
+        self._conn.execute(
+            f"INSERT INTO daily_stats (account, day, {', '.join(cols)}) VALUES (?, ?, {', '.join('?' * len(cols))}) "
+            f"ON CONFLICT (account, day) DO UPDATE SET {', '.join(f'{col} = {col} + excluded.{col}' for col in cols)}",
+            (account, day, *(deltas[col] for col in cols))
+        )
+
+    def _add(self, account: str, day: str, objects: dict) -> int:
+        """Adds whichever objects aren't counted yet to the ledger and their day's row"""
+        seen = {row[0] for row in self._conn.execute(
+            f"SELECT object_id FROM stats_objects WHERE account = ? AND object_id IN ({', '.join('?' * len(objects))})",
+            (account, *objects)
+        )}
+        new = [(object_id, deltas) for object_id, deltas in objects.items() if object_id not in seen]
+        if not new:
+            return 0
+        self._conn.executemany(
+            f"INSERT INTO stats_objects (account, object_id, day, {', '.join(FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(account, object_id, day, *(deltas.get(col, 0) for col in FIELDS)) for object_id, deltas in new]
+        )
+        self._increment(account, day, {col: sum(deltas.get(col, 0) for _, deltas in new) for col in FIELDS})
+        return len(new)
+
+    async def record(self, account: str, object_id: str, day: str, **deltas) -> bool:
+        """
+        :param account: [str] - connected account id
+        :param object_id: [str] - Stripe id of the object being counted
+        :param day: [str] - YYYY-MM-DD
+        :param deltas: amounts the object adds to any of FIELDS
+        :return: False if the object had already been counted
+        """
+        return await self._run(self._transaction, self._add, account, day, {object_id: deltas}) == 1
+
+    async def add_objects(self, account: str, day: str, objects: dict):
+        """
+        Counts any of a page of a day's objects, as listed by Stripe, that webhooks haven't
+        :param objects: [dict] - {object_id: deltas}
+        """
+        if objects:
+            await self._run(self._transaction, self._add, account, day, objects)
+
+    def _finish_reconcile(self, account: str, available: int, days: tuple):
+        for day in days:
+            # Rebuilt from the ledger, which also drops any figures counted before it existed
+            totals = self._conn.execute(
+                f"SELECT {', '.join(f'COALESCE(SUM({col}), 0)' for col in FIELDS)} FROM stats_objects WHERE account = ? AND day = ?",
+                (account, day)
+            ).fetchone()
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO daily_stats (account, day, {', '.join(FIELDS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                (account, day, *totals)
+            )
+        now = time.time()
+        self._conn.execute("INSERT OR REPLACE INTO balances (account, available, updated_at) VALUES (?, ?, ?)", (account, available, now))
+        self._conn.execute("INSERT OR REPLACE INTO reconciled (account, reconciled_at) VALUES (?, ?)", (account, now))
+        # Only the days just reconciled are ever read, so older ledger entries can go
+        self._conn.execute("DELETE FROM stats_objects WHERE account = ? AND day < ?", (account, min(days)))
+
+    async def finish_reconcile(self, account: str, available: int, *days: str):
+        """
+        Called once every page of the days' objects has gone through add_objects: records the
+        balance and marks the account reconciled, so `get` serves its rows from now on
+        :param available: [int] - balance from Stripe
+        """
+        await self._run(self._transaction, self._finish_reconcile, account, available, days)
+
+    async def set_balance(self, account: str, available: int):
+        await self._run(
+            self._conn.execute,
+            "INSERT OR REPLACE INTO balances (account, available, updated_at) VALUES (?, ?, ?)",
+            (account, available, time.time())
+        )
+
+    def _get(self, account: str, days: tuple):
+        # Webhooks write balances and day rows too, so only a completed reconciliation makes them servable
+        balance = self._conn.execute(
+            "SELECT available FROM reconciled JOIN balances USING (account) WHERE account = ?", (account,)
+        ).fetchone()
+        if balance is None:
+            return None
+
+        rows = {day: dict.fromkeys(FIELDS, 0) for day in days}
+        for row in self._conn.execute(
+            f"SELECT day, {', '.join(FIELDS)} FROM daily_stats WHERE account = ? AND day IN ({', '.join('?' * len(days))})",
+            (account, *days)
+        ):
+            rows[row[0]] = dict(zip(FIELDS, row[1:]))
+        return balance[0], rows
+
+    async def get(self, account: str, *days: str) -> Optional[tuple]:
+        """
+        :return: (balance, {day: row}), or None for an account that has never been reconciled
+        """
+        return await self._run(self._get, account, days)
+
+    async def accounts(self) -> list:
+        """
+        :return: every account that has been reconciled at least once
+        """
+        cur = await self._run(self._conn.execute, "SELECT account FROM reconciled")
+        return [row[0] for row in cur.fetchall()]
+
+    def _try_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        cur = self._conn.execute(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+            (name, holder, now + ttl, now)
+        )
+        return cur.rowcount == 1
+
+    async def try_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """
+        Takes or renews a named lease, so one worker process out of several runs a periodic job
+        :param name: [str] - job name
+        :param holder: [str] - identifies the calling process
+        :param ttl: [float] - seconds until another process may take the lease over
+        :return: True if `holder` now holds the lease
+        """
+        return await self._run(self._try_lease, name, holder, ttl)
+
+    async def close(self):
+        await self._run(self._conn.close)
+
+
+stats_store = StatsStore(config.STATS_STORE_PATH)
@@ -0,0 +1,191 @@
+import asyncio
+import importlib.util
+import logging
+import random
+import time
+import uuid
+from typing import Optional
+
+import httpx
+import stripe
+
+# Directory Modules
+import config
+from cache import TTLCache
+from log import stripe_request_id
+from metrics import STRIPE_DURATION, STRIPE_ERRORS, STRIPE_IN_FLIGHT, STRIPE_QUEUE_DEPTH, STRIPE_RETRIES
+from rate_limit import TokenBucket
+
+
+# The configured rates are for the whole deployment, so each worker process takes its share
+_share = 1 / max(1, config.SERVER_WORKERS)
+global_bucket = TokenBucket(config.STRIPE_GLOBAL_RATE * _share)
+# One bucket per connected account; idle ones are evicted
+account_buckets = TTLCache(10000, 600)
+
+logger = logging.getLogger(__name__)
+
+
+def configure_stripe():
+    """Points the SDK at the configured key and API base. Every Stripe caller imports this module"""
+    stripe.api_key = config.STRIPE_API_KEY
+    if config.STRIPE_API_BASE:
+        stripe.api_base = stripe.upload_api_base = config.STRIPE_API_BASE
+
+
+configure_stripe()
+
+
+class PooledHTTPXClient(stripe.HTTPXClient):
+    """
+    The SDK's httpx backend, sending through a pool sized and kept alive by config
+    rather than the AsyncClient defaults HTTPXClient builds for itself. The pool is
+    `client`, also used for requests the SDK can't make, such as streamed file uploads
+    """
+    def __init__(self):
+        super().__init__(timeout=httpx.Timeout(config.STRIPE_TIMEOUT, connect=config.STRIPE_CONNECT_TIMEOUT))
+        # The one private attribute this relies on; checked here so an SDK change fails at startup, not mid-request
+        if not isinstance(getattr(self, "_client_async", None), httpx.AsyncClient):
+            raise RuntimeError(f"stripe {stripe.VERSION}'s HTTPXClient has no _client_async to replace")
+        self.http2 = config.STRIPE_HTTP2 and importlib.util.find_spec("h2") is not None
+        self.client = httpx.AsyncClient(
+            verify=stripe.ca_bundle_path if self._verify_ssl_certs else False,
+            limits=httpx.Limits(
+                max_connections=config.STRIPE_POOL_LIMIT,
+                max_keepalive_connections=config.STRIPE_POOL_KEEPALIVE,
+                keepalive_expiry=config.STRIPE_KEEPALIVE_TIMEOUT,
+            ),
+            http2=self.http2,
+        )
+        # The default client HTTPXClient built is never used, but still closed along with the pool
+        self._default_client, self._client_async = self._client_async, self.client
+
+    async def close_async(self):
+        await self._default_client.aclose()
+        await super().close_async()
+
+
+_http_client: Optional[PooledHTTPXClient] = None
+
+
+def open_http_client() -> PooledHTTPXClient:
+    """
+    Creates this process's Stripe connection pool and makes it the SDK's default, so every
+    router's calls share it. Called from the app lifespan, or by the first call() without one
+    :return: PooledHTTPXClient
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = PooledHTTPXClient()
+        stripe.default_http_client = _http_client
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.close_async()
+        if stripe.default_http_client is _http_client:
+            stripe.default_http_client = None
+        _http_client = None
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, (stripe.RateLimitError, stripe.APIConnectionError)):
+        return True
+    return isinstance(e, stripe.StripeError) and (e.http_status or 0) >= 500
+
+
+def backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(config.STRIPE_RETRY_MAX_DELAY, config.STRIPE_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def resource_of(method) -> tuple:
+    """
+    :return: (resource, operation) e.g. ('Customer', 'create') for stripe.Customer.create_async
+    """
+    resource, _, operation = method.__qualname__.rpartition(".")
+    return resource or "stripe", operation.removesuffix("_async")
+
+
+async def acquire(stripe_account: str = None):
+    STRIPE_QUEUE_DEPTH.inc()
+    try:
+        if stripe_account is not None:
+            bucket = account_buckets.get(stripe_account)
+            if bucket is None:
+                bucket = TokenBucket(config.STRIPE_ACCOUNT_RATE * _share)
+            account_buckets.set(stripe_account, bucket)
+            await bucket.acquire()
+        await global_bucket.acquire()
+    finally:
+        STRIPE_QUEUE_DEPTH.dec()
+
+
+async def call(method, *args, **params):
+    """
+    Runs an async Stripe SDK call under the global and per-account rate limits, retrying
+    429s, 5xxs and connection errors with jittered exponential backoff. Create calls get an
+    idempotency key, reused across retries, so a retry can't create the object twice.
+
+    :param method: async SDK method, e.g. stripe.Customer.create_async
+    :param args: positional arguments for `method`
+    :param params: keyword arguments for `method`, including stripe_account
+    :return: whatever `method` returns
+    """
+    if _http_client is None:
+        open_http_client()
+    if method.__name__ == "create_async":
+        params.setdefault("idempotency_key", str(uuid.uuid4()))
+
+    resource, operation = resource_of(method)
+    account = params.get("stripe_account") or "platform"
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        await acquire(params.get("stripe_account"))
+        STRIPE_IN_FLIGHT.inc(resource)
+        try:
+            result = await method(*args, **params)
+            elapsed = time.perf_counter() - start
+            STRIPE_DURATION.observe(elapsed, resource, operation, account)
+            # Later records in this request carry the ID of the Stripe request that preceded them
+            stripe_request_id.set(getattr(getattr(result, "last_response", None), "request_id", None))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Stripe call", extra={
+                    "resource": resource, "operation": operation, "account": account,
+                    "attempts": attempt + 1, "duration_ms": round(elapsed * 1000, 2)
+                })
+            return result
+        except Exception as e:
+            if attempt >= config.STRIPE_MAX_RETRIES or not is_retryable(e):
+                STRIPE_DURATION.observe(time.perf_counter() - start, resource, operation, account)
+                STRIPE_ERRORS.inc(resource, operation, account, type(e).__name__)
+                stripe_request_id.set(getattr(e, "request_id", None))
+                raise
+            stripe_request_id.set(getattr(e, "request_id", None))
+            logger.warning("Retrying Stripe call", extra={
+                "resource": resource, "operation": operation, "account": account,
+                "attempt": attempt + 1, "error": type(e).__name__
+            })
+        finally:
+            STRIPE_IN_FLIGHT.dec(resource)
+
+        delay = backoff(attempt)
+        attempt += 1
+        STRIPE_RETRIES.inc(resource)
+        await asyncio.sleep(delay)
+
+
+def stats() -> dict:
+    """
+    :return: callers queued for a rate-limit token, calls in flight and total retries
+    """
+    return {
+        "queue_depth": STRIPE_QUEUE_DEPTH.value(),
+        "in_flight": STRIPE_IN_FLIGHT.total(),
+        "retries": STRIPE_RETRIES.total(),
+        "accounts": len(account_buckets),
+        "http2": _http_client is not None and _http_client.http2,
+    }
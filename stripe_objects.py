@@ -0,0 +1,74 @@
+import stripe
+
+# Directory Modules
+import stripe_gateway
+from cache import customer_index, product_index, customer_key, product_key, compact_customer, compact_product
+
+
+def search_literal(value: str) -> str:
+    """Quotes `value` for the Search API query language"""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+async def get_or_create_customer(stripe_account: str, name: str, email: str = None, description: str = None) -> dict:
+    """
+    Returns the account's existing customer with this email, creating one only if Stripe has none.
+    Concurrent calls for the same email share a single lookup, so they can't create duplicates
+    :param stripe_account: [str]
+    :param name: [str]
+    :param email: [str] - customers without one are always created
+    :param description: [str]
+    :return: {"id", "name", "email"}
+    """
+    if email:
+        # Stripe matches emails case-sensitively, so the lookup, the create and the cache key all use one form
+        email = email.strip().lower()
+
+    async def create():
+        customer = await stripe_gateway.call(stripe.Customer.create_async,
+            name=name, email=email, description=description, stripe_account=stripe_account
+        )
+        return compact_customer(customer)
+
+    if not email:
+        return await create()
+
+    async def lookup_or_create():
+        existing = await stripe_gateway.call(stripe.Customer.list_async, email=email, limit=1, stripe_account=stripe_account)
+        if existing["data"]:
+            return compact_customer(existing["data"][0])
+        return await create()
+
+    return await customer_index.get(customer_key(stripe_account, email), lookup_or_create)
+
+
+async def get_or_create_product(stripe_account: str, name: str, **fields) -> dict:
+    """
+    Returns the account's active product with this name, creating one only if Stripe has none.
+    Search results lag new products by up to a minute, which the cache covers within a process.
+    Only active products are looked up or cached, so an inactive one is always created
+    :param stripe_account: [str]
+    :param name: [str]
+    :param fields: any other Product.create parameters, e.g. description, active
+    :return: {"id", "name", "description"}
+    """
+    async def create():
+        product = await stripe_gateway.call(stripe.Product.create_async, name=name, **fields, stripe_account=stripe_account)
+        return compact_product(product)
+
+    if fields.get("active") is False:
+        return await create()
+
+    async def lookup_or_create():
+        try:
+            existing = await stripe_gateway.call(stripe.Product.search_async,
+                query=f"name:{search_literal(name)} AND active:'true'", limit=1, stripe_account=stripe_account
+            )
+            if existing["data"]:
+                return compact_product(existing["data"][0])
+        except stripe.InvalidRequestError:
+            # Search isn't available in every region; fall through to creating the product
+            pass
+        return await create()
+
+    return await product_index.get(product_key(stripe_account, name), lookup_or_create)
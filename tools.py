@@ -1,10 +1,14 @@
+import logging
 from typing import Tuple
 
 from pydantic import BaseModel
 
 
+logger = logging.getLogger(__name__)
+
+
 def print_exception(func_name, e):
-    print(f"{func_name}, Type: {type(e)} Error: {str(e)}")
+    logger.error("%s failed", func_name, extra={"error_type": type(e).__name__, "error": str(e)})
 
 
 def validate_against_enum(target_enum, v) -> bool:
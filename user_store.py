@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from typing import Optional
+
+import asyncpg
+
+# Directory Modules
+import config
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGSERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        stripe_account TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+
+# A row without a stripe_account is a signup still talking to Stripe. It holds the
+# email for SIGNUP_CLAIM_TTL seconds, after which a crashed signup's claim can be retaken
+FIND_USER = """
+    SELECT 1 FROM users
+    WHERE email = $1 AND (stripe_account IS NOT NULL OR created_at > now() - make_interval(secs => $2))
+"""
+CLAIM_USER = """
+    INSERT INTO users (email) VALUES ($1)
+    ON CONFLICT (email) DO UPDATE SET created_at = now()
+    WHERE users.stripe_account IS NULL AND users.created_at <= now() - make_interval(secs => $2)
+    RETURNING id
+"""
+SET_ACCOUNT = "UPDATE users SET stripe_account = $2 WHERE id = $1"
+RELEASE_USER = "DELETE FROM users WHERE id = $1 AND stripe_account IS NULL"
+
+
+def normalise_email(email: str) -> str:
+    # Two casings of one address are the same user
+    return email.strip().lower()
+
+
+class UserConnection(asyncpg.Connection):
+    """
+    Pool connection for the user statements. asyncpg prepares a statement the first time a
+    connection runs it, then reuses it from that connection's statement cache
+    """
+    async def prepare_statements(self):
+        """Runs each statement once in a transaction that's rolled back, so none is parsed during a signup"""
+        transaction = self.transaction()
+        await transaction.start()
+        try:
+            await self.fetchval(FIND_USER, "", 0.0)
+            await self.fetchval(CLAIM_USER, "", 0.0)
+            await self.execute(SET_ACCOUNT, 0, None)
+            await self.execute(RELEASE_USER, 0)
+        finally:
+            await transaction.rollback()
+
+
+class UserStore:
+    """
+    Local record of signed-up users, so /auth/signup can turn away an email that already
+    has an account without asking Stripe. Signups claim their email before the Stripe
+    calls, so two concurrent signups for one email can't both create accounts.
+    """
+    def __init__(self, dsn: Optional[str]):
+        self.dsn = dsn
+        self._pool: Optional[asyncpg.Pool] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._pool is not None
+
+    async def open(self):
+        """Creates the table if needed and this worker's pool. Called once from the app lifespan"""
+        if self._pool is not None or not self.dsn:
+            return
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            # Statements are prepared when each pool connection opens, so the table has to exist first
+            await conn.execute(SCHEMA)
+        finally:
+            await conn.close()
+        self._pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=config.DB_POOL_MIN_SIZE,
+            max_size=config.DB_POOL_MAX_SIZE,
+            command_timeout=config.DB_COMMAND_TIMEOUT,
+            connection_class=UserConnection,
+            init=UserConnection.prepare_statements,
+        )
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def acquire(self):
+        """
+        :return: async context manager yielding a UserConnection
+        """
+        return self._pool.acquire()
+
+    async def claim(self, conn: UserConnection, email: str) -> Optional[int]:
+        """
+        :param conn: [UserConnection]
+        :param email: [str]
+        :return: id of the new user row, or None if the email is already taken
+        """
+        return await conn.fetchval(CLAIM_USER, normalise_email(email), config.SIGNUP_CLAIM_TTL)
+
+    async def set_account(self, user_id: int, stripe_account: str):
+        """
+        Records the finished signup's account, after which its claim never lapses. Retried with
+        backoff: an account left unrecorded lets its email sign up again once the claim lapses
+        """
+        for attempt in range(config.DB_SET_ACCOUNT_ATTEMPTS):
+            try:
+                async with self.acquire() as conn:
+                    await conn.execute(SET_ACCOUNT, user_id, stripe_account)
+                return
+            except Exception:
+                if attempt == config.DB_SET_ACCOUNT_ATTEMPTS - 1:
+                    raise
+                logger.warning("Retrying recording a connected account", extra={"user_id": user_id, "attempt": attempt + 1})
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+    async def release(self, user_id: int):
+        """Gives up a claim whose signup failed, so the email can be used again straight away"""
+        try:
+            async with self.acquire() as conn:
+                await conn.execute(RELEASE_USER, user_id)
+        except Exception:
+            # The claim still lapses after SIGNUP_CLAIM_TTL
+            logger.exception("Failed to release signup claim", extra={"user_id": user_id})
+
+
+user_store = UserStore(config.DATABASE_URL)
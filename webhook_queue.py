@@ -0,0 +1,482 @@
+import abc
+import argparse
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+# Directory Modules
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts: int, base: float, cap: float) -> float:
+    """Jittered exponential backoff before an item that has failed `attempts` times is retried"""
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class QueueItem(NamedTuple):
+    id: object
+    path: int
+    body: bytes
+    attempts: int
+
+
+class WebhookQueue(abc.ABC):
+    """
+    Durable FIFO for raw webhook bodies. Items are claimed by `get`, and stay
+    in the backend until they're acked, so a crash mid-processing doesn't
+    lose them. A nacked item waits out a backoff before it can be claimed again,
+    and one that has failed max_attempts times is parked as dead until redriven.
+    Claims older than the visibility timeout are taken to be orphaned by a dead
+    consumer, and `recover` requeues them.
+    """
+    @abc.abstractmethod
+    async def put(self, path: int, body: bytes): ...
+
+    @abc.abstractmethod
+    async def get(self) -> Optional[QueueItem]: ...
+
+    @abc.abstractmethod
+    async def ack(self, item: QueueItem): ...
+
+    @abc.abstractmethod
+    async def nack(self, item: QueueItem): ...
+
+    @abc.abstractmethod
+    async def size(self) -> int: ...
+
+    @abc.abstractmethod
+    async def dead(self) -> int: ...
+
+    @abc.abstractmethod
+    async def redrive(self, limit: int = None) -> int: ...
+
+    @abc.abstractmethod
+    async def recover(self): ...
+
+    async def close(self):
+        pass
+
+
+class SQLiteQueue(WebhookQueue):
+    PENDING, CLAIMED, DEAD = 0, 1, 2
+
+    def __init__(self, path: str, max_attempts: int, retry_base_delay: float, retry_max_delay: float,
+                 visibility_timeout: int = 300):
+        """
+        :param path: [str] - database file, shared by every worker process
+        :param max_attempts: [int] - items failing this many times are parked as dead
+        :param retry_base_delay: [float] - seconds before the first retry, doubling with each failure
+        :param retry_max_delay: [float] - longest wait between retries
+        :param visibility_timeout: [int] - seconds before a claimed item is considered orphaned
+        """
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.visibility_timeout = visibility_timeout
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path INTEGER,
+                body BLOB NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                state INTEGER NOT NULL DEFAULT 0,
+                claimed_at REAL,
+                available_at REAL NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(webhook_queue)")}
+        if "available_at" not in columns:
+            # Queues created before retries were delayed
+            self._conn.execute("ALTER TABLE webhook_queue ADD COLUMN available_at REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS webhook_queue_state ON webhook_queue (state, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS webhook_queue_ready ON webhook_queue (state, available_at, id)")
+
+    async def _run(self, func, *args):
+        def locked():
+            with self._lock:
+                return func(*args)
+        return await asyncio.to_thread(locked)
+
+    def _put(self, path, body):
+        self._conn.execute("INSERT INTO webhook_queue (path, body, available_at) VALUES (?, ?, ?)", (path, body, time.time()))
+
+    def _claim(self):
+        # IMMEDIATE takes the write lock up front so two processes can't claim the same row
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Items are ordered by when they became available, so retries rejoin the back of the queue
+            row = self._conn.execute(
+                "SELECT id, path, body, attempts FROM webhook_queue WHERE state = ? AND available_at <= ? "
+                "ORDER BY available_at, id LIMIT 1",
+                (self.PENDING, time.time())
+            ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE webhook_queue SET state = ?, attempts = attempts + 1, claimed_at = ? WHERE id = ?",
+                    (self.CLAIMED, time.time(), row[0])
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return None if row is None else QueueItem(row[0], row[1], row[2], row[3] + 1)
+
+    def _release(self, item: QueueItem):
+        if item.attempts >= self.max_attempts:
+            self._conn.execute("UPDATE webhook_queue SET state = ?, claimed_at = NULL WHERE id = ?", (self.DEAD, item.id))
+            return
+        available_at = time.time() + retry_delay(item.attempts, self.retry_base_delay, self.retry_max_delay)
+        self._conn.execute(
+            "UPDATE webhook_queue SET state = ?, claimed_at = NULL, available_at = ? WHERE id = ?",
+            (self.PENDING, available_at, item.id)
+        )
+
+    def _redrive(self, limit):
+        cur = self._conn.execute(
+            "UPDATE webhook_queue SET state = ?, attempts = 0, available_at = ? "
+            "WHERE id IN (SELECT id FROM webhook_queue WHERE state = ? ORDER BY id LIMIT ?)",
+            (self.PENDING, time.time(), self.DEAD, -1 if limit is None else limit)
+        )
+        return cur.rowcount
+
+    async def put(self, path: int, body: bytes):
+        await self._run(self._put, path, body)
+
+    async def get(self) -> Optional[QueueItem]:
+        return await self._run(self._claim)
+
+    async def ack(self, item: QueueItem):
+        await self._run(self._conn.execute, "DELETE FROM webhook_queue WHERE id = ?", (item.id,))
+
+    async def nack(self, item: QueueItem):
+        await self._run(self._release, item)
+
+    async def size(self) -> int:
+        cur = await self._run(self._conn.execute, "SELECT COUNT(*) FROM webhook_queue WHERE state = ?", (self.PENDING,))
+        return cur.fetchone()[0]
+
+    async def dead(self) -> int:
+        cur = await self._run(self._conn.execute, "SELECT COUNT(*) FROM webhook_queue WHERE state = ?", (self.DEAD,))
+        return cur.fetchone()[0]
+
+    async def redrive(self, limit: int = None) -> int:
+        """
+        Gives dead items a fresh set of attempts, oldest first
+        :return: number of items requeued
+        """
+        return await self._run(self._redrive, limit)
+
+    async def recover(self):
+        """Requeues items claimed longer than the visibility timeout ago, whose consumer must have died"""
+        now = time.time()
+        await self._run(
+            self._conn.execute,
+            "UPDATE webhook_queue SET state = ?, claimed_at = NULL, available_at = ? WHERE state = ? AND claimed_at < ?",
+            (self.PENDING, now, self.CLAIMED, now - self.visibility_timeout)
+        )
+
+    async def close(self):
+        await self._run(self._conn.close)
+
+
+class RedisQueue(WebhookQueue):
+    PENDING = "webhooks:pending"
+    PROCESSING = "webhooks:processing"
+    CLAIMS = "webhooks:claims"  # sorted set of PROCESSING items scored by when they were claimed
+    DELAYED = "webhooks:delayed"  # sorted set scored by when the item may be retried
+    DEAD = "webhooks:dead"
+
+    # Moves due retries onto the back of PENDING. Atomic, so two consumers can't both move one
+    PROMOTE = """
+        local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        for _, raw in ipairs(due) do
+            redis.call('ZREM', KEYS[1], raw)
+            redis.call('LPUSH', KEYS[2], raw)
+        end
+        return #due
+    """
+    # Moves up to ARGV[1] dead items back onto PENDING with their attempts reset
+    REDRIVE = """
+        local moved = 0
+        while moved < tonumber(ARGV[1]) do
+            local raw = redis.call('LPOP', KEYS[1])
+            if not raw then break end
+            local path, body = string.match(raw, '^(%d+):%d+:(.*)$')
+            redis.call('LPUSH', KEYS[2], path .. ':0:' .. body)
+            moved = moved + 1
+        end
+        return moved
+    """
+
+    # Requeues PROCESSING items claimed before ARGV[2]. An item with no claim time was taken by a
+    # consumer that died before recording one, so it's stamped now and expires a timeout later
+    RECOVER = """
+        for _, raw in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+            if not redis.call('ZSCORE', KEYS[2], raw) then
+                redis.call('ZADD', KEYS[2], ARGV[1], raw)
+            end
+        end
+        local moved = 0
+        for _, raw in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])) do
+            redis.call('ZREM', KEYS[2], raw)
+            if redis.call('LREM', KEYS[1], 1, raw) > 0 then
+                redis.call('RPUSH', KEYS[3], raw)
+                moved = moved + 1
+            end
+        end
+        return moved
+    """
+
+    def __init__(self, url: str, max_attempts: int, retry_base_delay: float, retry_max_delay: float,
+                 visibility_timeout: int = 300, block_timeout: float = 1):
+        from redis import asyncio as aioredis
+
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.visibility_timeout = visibility_timeout
+        self.block_timeout = block_timeout
+        self._redis = aioredis.from_url(url)
+        self._promote = self._redis.register_script(self.PROMOTE)
+        self._redrive = self._redis.register_script(self.REDRIVE)
+        self._recover = self._redis.register_script(self.RECOVER)
+
+    @staticmethod
+    def _encode(path: int, attempts: int, body: bytes) -> bytes:
+        return f"{path}:{attempts}:".encode() + body
+
+    @staticmethod
+    def _decode(raw: bytes) -> QueueItem:
+        path, attempts, body = raw.split(b":", 2)
+        return QueueItem(raw, int(path), body, int(attempts))
+
+    async def put(self, path: int, body: bytes):
+        await self._redis.lpush(self.PENDING, self._encode(path, 0, body))
+
+    async def get(self) -> Optional[QueueItem]:
+        await self._promote(keys=[self.DELAYED, self.PENDING], args=[time.time(), 100])
+        # Reliable queue pattern: the item sits in PROCESSING until it's acked
+        raw = await self._redis.blmove(self.PENDING, self.PROCESSING, self.block_timeout, "RIGHT", "LEFT")
+        if raw is None:
+            return None
+        await self._redis.zadd(self.CLAIMS, {raw: time.time()})
+        item = self._decode(raw)
+        return item._replace(attempts=item.attempts + 1)
+
+    async def ack(self, item: QueueItem):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(self.PROCESSING, 1, item.id)
+            pipe.zrem(self.CLAIMS, item.id)
+            await pipe.execute()
+
+    async def nack(self, item: QueueItem):
+        raw = self._encode(item.path, item.attempts, item.body)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(self.PROCESSING, 1, item.id)
+            pipe.zrem(self.CLAIMS, item.id)
+            if item.attempts >= self.max_attempts:
+                pipe.rpush(self.DEAD, raw)
+            else:
+                available_at = time.time() + retry_delay(item.attempts, self.retry_base_delay, self.retry_max_delay)
+                pipe.zadd(self.DELAYED, {raw: available_at})
+            await pipe.execute()
+
+    async def size(self) -> int:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.llen(self.PENDING)
+            pipe.zcard(self.DELAYED)
+            pending, delayed = await pipe.execute()
+        return pending + delayed
+
+    async def dead(self) -> int:
+        return await self._redis.llen(self.DEAD)
+
+    async def redrive(self, limit: int = None) -> int:
+        """
+        Gives dead items a fresh set of attempts, oldest first
+        :return: number of items requeued
+        """
+        return await self._redrive(keys=[self.DEAD, self.PENDING], args=[2 ** 31 if limit is None else limit])
+
+    async def recover(self):
+        """Moves items claimed longer than the visibility timeout ago back to the head of PENDING"""
+        now = time.time()
+        await self._recover(keys=[self.PROCESSING, self.CLAIMS, self.PENDING], args=[now, now - self.visibility_timeout])
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def create_queue() -> WebhookQueue:
+    retries = (config.WEBHOOK_QUEUE_MAX_ATTEMPTS, config.WEBHOOK_RETRY_BASE_DELAY, config.WEBHOOK_RETRY_MAX_DELAY,
+               config.WEBHOOK_QUEUE_VISIBILITY_TIMEOUT)
+    if config.WEBHOOK_QUEUE_BACKEND == "redis":
+        return RedisQueue(config.REDIS_URL, *retries)
+    return SQLiteQueue(config.WEBHOOK_QUEUE_PATH, *retries)
+
+
+class WorkerPool:
+    def __init__(self, queue: WebhookQueue, handler: Callable[[bytes, int], Awaitable], workers: int,
+                 max_depth: int, poll_interval: float = 1, recover_interval: float = 30, prefetch: int = 1):
+        """
+        :param queue: [WebhookQueue]
+        :param handler: [Callable] - coroutine taking (body, path)
+        :param workers: [int] - number of concurrent consumers
+        :param max_depth: [int] - pending items beyond which `submit` refuses new work
+        :param poll_interval: [float] - seconds an idle consumer waits before polling again
+        :param recover_interval: [float] - seconds between passes requeueing orphaned claims
+        :param prefetch: [int] - items each consumer may hold claimed and in progress at once
+        """
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.max_depth = max_depth
+        self.poll_interval = poll_interval
+        self.recover_interval = recover_interval
+        self.prefetch = prefetch
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._recovery = None
+        self._stopping = False
+
+    async def submit(self, path: int, body: bytes) -> bool:
+        """
+        Persists the body before returning
+        :return: False when the queue is full and the sender should retry later
+        """
+        if await self.queue.size() >= self.max_depth:
+            return False
+        await self.queue.put(path, body)
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        self._recovery = asyncio.create_task(self._recover())
+
+    async def stop(self, timeout: float = 10):
+        """Lets in-flight events finish; anything unacked is requeued by a later recovery pass, in any process"""
+        self._stopping = True
+        self._wakeup.set()
+        self._recovery.cancel()
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout) if self._tasks else ((), ())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(self._recovery, return_exceptions=True)
+
+    async def _recover(self):
+        # Every process runs this, so a crashed worker's claims are picked up by the survivors
+        while True:
+            try:
+                await self.queue.recover()
+            except Exception:
+                logger.exception("Failed to recover orphaned webhook queue items")
+            await asyncio.sleep(self.recover_interval)
+
+    async def _consume(self):
+        in_flight = set()
+        try:
+            while not self._stopping:
+                if len(in_flight) >= self.prefetch:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                item = await self._claim()
+                if item is not None:
+                    task = asyncio.create_task(self._process(item))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def _claim(self) -> Optional[QueueItem]:
+        """
+        :return: the next item, or None after waiting for one to be submitted
+        """
+        try:
+            item = await self.queue.get()
+        except Exception:
+            logger.exception("Failed to read from the webhook queue")
+            await asyncio.sleep(self.poll_interval)
+            return None
+
+        if item is None:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            if not self._stopping:
+                self._wakeup.clear()
+        return item
+
+    async def _process(self, item: QueueItem):
+        try:
+            await self.handler(item.body, item.path)
+            await self.queue.ack(item)
+        except Exception:
+            logger.exception("Webhook processing failed", extra={"queue_item": item.id, "path": item.path, "attempts": item.attempts})
+            await self.queue.nack(item)
+
+
+_pool: Optional[WorkerPool] = None
+
+
+async def start(handler: Callable[[bytes, int], Awaitable]) -> WorkerPool:
+    """
+    Opens the configured queue and starts its consumers. Safe to call repeatedly
+    :param handler: [Callable] - coroutine taking (body, path)
+    :return: WorkerPool
+    """
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(queue=create_queue(), handler=handler, workers=config.WEBHOOK_WORKERS,
+                           max_depth=config.WEBHOOK_QUEUE_MAX_DEPTH, recover_interval=config.WEBHOOK_QUEUE_RECOVER_INTERVAL,
+                           prefetch=config.WEBHOOK_BATCH_SIZE if config.WEBHOOK_BATCHING else 1)
+        _pool.start()
+    return _pool
+
+
+async def stop():
+    global _pool
+    if _pool is not None:
+        await _pool.stop()
+        await _pool.queue.close()
+        _pool = None
+
+
+async def main():
+    """
+    Operator commands for the configured queue, e.g. after a Django outage has parked events as dead
+
+        python webhook_queue.py status
+        python webhook_queue.py redrive --limit 1000
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["status", "redrive"])
+    parser.add_argument("--limit", type=int, help="Most dead items to redrive")
+    args = parser.parse_args()
+
+    queue = create_queue()
+    try:
+        if args.command == "redrive":
+            print(f"Requeued {await queue.redrive(args.limit)} dead items")
+        print(f"pending={await queue.size()} dead={await queue.dead()}")
+    finally:
+        await queue.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
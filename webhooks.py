@@ -1,14 +1,211 @@
+import asyncio
+import logging
+import re
+from collections import defaultdict
+from typing import Optional
+
 import aiohttp
-import json
+
+# Directory Modules
+import config
+import fastjson
+import webhook_queue
+from cache import price_cache, apply_customer_event, apply_product_event
+from dedup import create_deduplicator, extract_event_id
+from http_client import get_session
+from metrics import WEBHOOK_EVENTS, WEBHOOK_REJECTED
+from signature import verify_signature
+from stats_store import stats_store, day_of
 
 # FastAPI
-from fastapi import APIRouter, Request, BackgroundTasks
+from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
 
 
 webhooks = APIRouter(prefix='/webhooks', tags=['webhooks'])
 
-DJANGO_URL = 'http://127.0.0.1:8000/api'
+logger = logging.getLogger(__name__)
+
+DJANGO_URL = config.DJANGO_URL
+
+deduplicator = create_deduplicator()
+
+
+class EventBatcher:
+    """
+    Buffers forwarded events per destination and posts them as a single JSON array
+    once WEBHOOK_BATCH_SIZE events are waiting or WEBHOOK_BATCH_INTERVAL has passed.
+
+    The receiver may answer with {"failed": [indexes]}; only those items are retried,
+    ahead of anything buffered since, so each destination still sees events in order.
+    """
+    def __init__(self, max_size: int, max_delay: float, max_retries: int):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self._pending = defaultdict(list)  # endpoint -> [[content, future, attempts], ...]
+        self._wakeups = defaultdict(asyncio.Event)
+        self._tasks = {}
+
+    async def add(self, endpoint: str, content: dict):
+        """Resolves once the event has been delivered, raises if it ran out of retries"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending[endpoint].append([content, future, 0])
+        if endpoint not in self._tasks:
+            self._tasks[endpoint] = asyncio.create_task(self._deliver(endpoint))
+        if len(self._pending[endpoint]) >= self.max_size:
+            self._wakeups[endpoint].set()
+        await future
+
+    async def _deliver(self, endpoint: str):
+        """One task per destination while it has events buffered, so batches go out strictly in order"""
+        pending = self._pending[endpoint]
+        wakeup = self._wakeups[endpoint]
+        while pending:
+            if len(pending) < self.max_size:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            wakeup.clear()
+            await self._flush(endpoint)
+        del self._tasks[endpoint]
+
+    async def _flush(self, endpoint: str):
+        pending = self._pending[endpoint]
+        batch = pending[:self.max_size]
+        del pending[:self.max_size]
+
+        failed = await self._send(endpoint, [item[0] for item in batch])
+        retry = []
+        for i, item in enumerate(batch):
+            content, future, attempts = item
+            if i not in failed:
+                future.done() or future.set_result(None)
+            elif attempts >= self.max_retries:
+                future.done() or future.set_exception(
+                    Exception(f"Delivery to {endpoint} failed after {self.max_retries} retries"))
+            else:
+                item[2] += 1
+                retry.append(item)
+        pending[:0] = retry
+
+    async def _send(self, endpoint: str, contents: list) -> set:
+        """
+        :return: indexes of the items the receiver didn't accept
+        """
+        session = await get_session()
+        try:
+            async with session.post(f"{DJANGO_URL}{endpoint}", json=contents) as response:
+                if response.status >= 400:
+                    return set(range(len(contents)))
+                try:
+                    body = await response.json(loads=fastjson.loads)
+                except (aiohttp.ContentTypeError, ValueError):
+                    return set()
+                return set(body.get('failed', [])) if isinstance(body, dict) else set()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Batch delivery failed", extra={"endpoint": endpoint, "size": len(contents), "error": repr(e)})
+            return set(range(len(contents)))
+
+    async def close(self):
+        """Sends whatever is still buffered"""
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+batcher = EventBatcher(
+    config.WEBHOOK_BATCH_SIZE, config.WEBHOOK_BATCH_INTERVAL, config.WEBHOOK_BATCH_MAX_RETRIES
+) if config.WEBHOOK_BATCHING else None
+
+
+async def forward_event(endpoint: str, content: dict):
+    """
+    Posts an event to the Django backend over the shared connection pool,
+    or hands it to the batcher when WEBHOOK_BATCHING is on
+    :param endpoint: [str] - path under DJANGO_URL e.g. '/receive-invoice-updates'
+    :param content: [dict] - event payload
+    """
+    if batcher is not None:
+        return await batcher.add(endpoint, content)
+
+    session = await get_session()
+    async with session.post(f"{DJANGO_URL}{endpoint}", json=content) as response:
+        response.raise_for_status()
+
+
+# Queue tags recording which endpoint an event arrived on. Dispatch is by event type,
+# so these are only kept for logging and for items queued before the registry existed
+PATH_TRANSACTIONS, PATH_INVOICE, PATH_CATALOG, PATH_STATS, PATH_UNIFIED = range(5)
+
+# event type -> handlers, each a coroutine taking the decoded event
+EVENT_HANDLERS = {}
+
+# Stripe serialises "type" as the envelope's last key, so a match right before the closing
+# brace can only be the event type; a nested object's "type" is always followed by more JSON
+EVENT_TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([^"\\]+)"\s*}\s*$')
+
+
+def on_event(*event_types: str):
+    """
+    Registers the decorated coroutine as a handler for each of `event_types`
+    :param event_types: [str] - Stripe event types e.g. 'invoice.paid'
+    """
+    def register(handler):
+        for event_type in event_types:
+            EVENT_HANDLERS.setdefault(event_type, []).append(handler)
+        return handler
+    return register
+
+
+def extract_event_type(body: bytes) -> Optional[str]:
+    """
+    Reads the event type off the end of the raw body without decoding the JSON
+    :param body: [bytes] - raw webhook body
+    :return: event type, or None when the body isn't laid out the way Stripe sends it
+    """
+    match = EVENT_TYPE_PATTERN.search(body, max(0, len(body) - 256))
+    return match.group(1).decode() if match else None
+
+
+async def enqueue_event(body: bytes, path: int, signature: str = None) -> JSONResponse:
+    """
+    Persists the raw body to the ingestion queue for the worker pool to process.
+    When the queue is full Stripe is told to retry later rather than the event being dropped
+    :param body: [bytes] - raw request body
+    :param path: [int] - PATH_* tag for the endpoint the event arrived on
+    :param signature: [str] - Stripe-Signature header, checked against the raw body before anything else
+    """
+    if config.STRIPE_WEBHOOK_SECRETS:
+        reason = verify_signature(body, signature, config.STRIPE_WEBHOOK_SECRETS, config.WEBHOOK_SIGNATURE_TOLERANCE)
+        if reason is not None:
+            WEBHOOK_REJECTED.inc(reason)
+            return JSONResponse(status_code=400, content={"message": "Invalid signature", "reason": reason})
+
+    event_type = extract_event_type(body)
+    if event_type is not None and event_type not in EVENT_HANDLERS:
+        WEBHOOK_EVENTS.inc(event_type, "ignored")
+        return JSONResponse(status_code=200, content={"message": "Event type ignored"})
+
+    event_id = extract_event_id(body)
+    if event_id is not None and await deduplicator.is_duplicate(event_id):
+        return JSONResponse(status_code=200, content={"message": "Duplicate event ignored"})
+
+    try:
+        pool = await webhook_queue.start(process_bytes)
+        submitted = await pool.submit(path, body)
+    except Exception:
+        # Not queued, so Stripe's retry of this event mustn't be taken for a duplicate
+        if event_id is not None:
+            await deduplicator.forget(event_id)
+        raise
+    if not submitted:
+        if event_id is not None:
+            await deduplicator.forget(event_id)
+        return JSONResponse(status_code=503, headers={"Retry-After": "30"}, content={"message": "Queue full, retry later"})
+    WEBHOOK_EVENTS.inc(event_type or "unknown", "received")
+    return JSONResponse(status_code=202, content={"message": "Successfully received event"})
 
 
 @webhooks.get('/')
@@ -16,71 +213,154 @@ async def read_root():
     return {"message": "Running"}
 
 
+@webhooks.get('/dedup/stats')
+async def dedup_stats():
+    return deduplicator.stats()
+
+
+@webhooks.post('/receive')
+async def webhook_receive(request: Request):
+    body = await request.body()
+    return await enqueue_event(body, PATH_UNIFIED, request.headers.get('stripe-signature'))
+
+
+# Kept so existing Stripe endpoint configurations keep working; they now accept any registered type
 @webhooks.post('/invoice/receive')
-async def webhook_invoice(request: Request, bg_task: BackgroundTasks):
+async def webhook_invoice(request: Request):
     body = await request.body()
-    bg_task.add_task(process_bytes, body, 1)
-    return JSONResponse(status_code=202, content={"message": "Successfully received event"})
+    return await enqueue_event(body, PATH_INVOICE, request.headers.get('stripe-signature'))
 
 
-async def process_bytes(body: bytes, path: int = None):
-    try:
-        event = json.loads(body)
-        if path == 1:
-            await process_invoice_event(event)
-        if path == 0:
-            await process_transaction_event(event)
-    except Exception as e:
-        print(f"({process_bytes.__name__}) {type(e)} - {str(e)}")
+@webhooks.post("/transactions/receive")
+async def webhook_transaction(request: Request):
+    body = await request.body()
+    return await enqueue_event(body, PATH_TRANSACTIONS, request.headers.get('stripe-signature'))
 
 
-async def process_invoice_event(event: dict):
-    try:
-        if event['type'] == 'invoice.paid':
-            content = {
-                'type': 'invoice.paid',
-                'data': {
-                    'invoice_id': event['data']['object']['id'],
-                    'amount_paid': event['data']['object']['amount_paid'],
-                    'created': event['data']['object']['created']
-                }
-            }
-            async with aiohttp.ClientSession() as session:
-                await session.post(f"{DJANGO_URL}/receive-invoice-updates", json=content)
-
-        if event['type'] == 'invoice.deleted':
-            content = {
-                'type': 'invoice.deleted',
-                'data': {
-                    'invoice_id': event['data']['object']['id'],
-                    'created': event['data']['object']['created']
-                }
-            }
-            async with aiohttp.ClientSession() as session:
-                await session.post(f"{DJANGO_URL}/receive-invoice-updates", json=content)
-    except Exception as e:
-        print(type(e), str(e))
+@webhooks.post("/catalog/receive")
+async def webhook_catalog(request: Request):
+    body = await request.body()
+    return await enqueue_event(body, PATH_CATALOG, request.headers.get('stripe-signature'))
 
 
-@webhooks.post("/transactions/receive")
-async def webhook_transaction(request: Request, bg_task: BackgroundTasks):
+@webhooks.post("/stats/receive")
+async def webhook_stats(request: Request):
     body = await request.body()
-    bg_task.add_task(process_bytes, body, 0)
-    return JSONResponse(status_code=202, content={"message": "Successfully received event"})
+    return await enqueue_event(body, PATH_STATS, request.headers.get('stripe-signature'))
+
+
+async def process_bytes(body: bytes, path: int = None):
+    """
+    Worker entry point: decodes the event and runs every handler registered for its type.
+    The type is checked on the raw bytes first, so events nothing handles are never decoded
+    :param body: [bytes] - raw webhook body
+    :param path: [int] - PATH_* tag, unused for dispatch
+    """
+    event_type = extract_event_type(body)
+    if event_type is not None and event_type not in EVENT_HANDLERS:
+        WEBHOOK_EVENTS.inc(event_type, "ignored")
+        return
 
+    event = fastjson.loads(body)
+    event_type = event.get('type')
+    handlers = EVENT_HANDLERS.get(event_type)
+    if handlers is None:
+        WEBHOOK_EVENTS.inc(event_type or "unknown", "ignored")
+        return
 
-async def process_transaction_event(event: dict):
     try:
-        if event['type'] == 'charge.succeeded':
-            content = {
-                'type': 'charge.succeeded',
-                'data': {
-                    'transaction_id': event['data']['object']['id'],
-                    'amount': event['data']['object']['amount_captured'],
-                    'created': event['data']['object']['created']
-                }
-            }
-            async with aiohttp.ClientSession() as session:
-                await session.post(f"{DJANGO_URL}/receive-transaction-updates", json=content)
+        for handler in handlers:
+            await handler(event)
     except Exception as e:
-        print(type(e), str(e))
+        WEBHOOK_EVENTS.inc(event_type, "failed")
+        logger.debug("Failed to handle %s", event_type, extra={"path": path, "error": repr(e)})
+        raise
+    WEBHOOK_EVENTS.inc(event_type, "processed")
+
+
+@on_event('invoice.paid')
+async def forward_invoice_paid(event: dict):
+    content = {
+        'type': 'invoice.paid',
+        'data': {
+            'invoice_id': event['data']['object']['id'],
+            'amount_paid': event['data']['object']['amount_paid'],
+            'created': event['data']['object']['created']
+        }
+    }
+    await forward_event("/receive-invoice-updates", content)
+
+
+@on_event('invoice.deleted')
+async def forward_invoice_deleted(event: dict):
+    content = {
+        'type': 'invoice.deleted',
+        'data': {
+            'invoice_id': event['data']['object']['id'],
+            'created': event['data']['object']['created']
+        }
+    }
+    await forward_event("/receive-invoice-updates", content)
+
+
+@on_event('charge.succeeded')
+async def forward_charge_succeeded(event: dict):
+    content = {
+        'type': 'charge.succeeded',
+        'data': {
+            'transaction_id': event['data']['object']['id'],
+            'amount': event['data']['object']['amount_captured'],
+            'created': event['data']['object']['created']
+        }
+    }
+    await forward_event("/receive-transaction-updates", content)
+
+
+@on_event('price.created', 'price.updated', 'price.deleted')
+async def invalidate_price(event: dict):
+    """Drops the cached product -> price lookup whenever one of the product's prices changes"""
+    price_cache.pop((event.get('account'), event['data']['object']['product']))
+
+
+@on_event('product.created', 'product.updated', 'product.deleted')
+async def invalidate_product(event: dict):
+    price_cache.pop((event.get('account'), event['data']['object']['id']))
+
+
+@on_event('customer.created', 'customer.updated', 'customer.deleted')
+async def index_customer(event: dict):
+    apply_customer_event(event.get('account'), event['type'], event['data']['object'], event['data'].get('previous_attributes'))
+
+
+@on_event('product.created', 'product.updated', 'product.deleted')
+async def index_product(event: dict):
+    apply_product_event(event.get('account'), event['type'], event['data']['object'], event['data'].get('previous_attributes'))
+
+
+# Connected-account events folded into the running daily aggregates behind /payments/get-stats
+@on_event('payment_intent.succeeded')
+async def record_sale(event: dict):
+    account, obj = event.get('account'), event['data']['object']
+    if account is not None:
+        await stats_store.record(account, obj['id'], day_of(obj['created']), sales=obj.get('amount_received') or 0, orders=1)
+
+
+@on_event('customer.created')
+async def record_new_customer(event: dict):
+    account, obj = event.get('account'), event['data']['object']
+    if account is not None:
+        await stats_store.record(account, obj['id'], day_of(obj['created']), new_customers=1)
+
+
+@on_event('issuing_transaction.created')
+async def record_transaction(event: dict):
+    account, obj = event.get('account'), event['data']['object']
+    if account is not None:
+        await stats_store.record(account, obj['id'], day_of(obj['created']), transactions=1)
+
+
+@on_event('balance.available')
+async def record_balance(event: dict):
+    account, obj = event.get('account'), event['data']['object']
+    if account is not None:
+        await stats_store.set_balance(account, obj['available'][0]['amount'])